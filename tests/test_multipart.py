@@ -0,0 +1,185 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from xml.etree import ElementTree
+from tubeup.multipart import MultipartUpload
+from tubeup.state import MultipartUploads
+
+
+class S3StandIn(ThreadingHTTPServer):
+    """
+    A local server with the part of the S3 API used by multipart uploads,
+    which can be told to fail some requests.
+    """
+
+    def __init__(self):
+        super(S3StandIn, self).__init__(('127.0.0.1', 0), S3Handler)
+        self.uploads = {}
+        self.objects = {}
+        self.requests = []
+        # Number of times the next PUTs of a part number answer 500
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+
+class S3Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, url.query))
+
+            if self.command == 'POST' and 'uploads' in params:
+                upload_id = 'upload-%d' % (len(server.uploads) + 1)
+                server.uploads[upload_id] = {}
+                return self.reply(200, (
+                    '<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                    '</InitiateMultipartUploadResult>' % upload_id).encode())
+
+            parts = server.uploads.get(params.get('uploadId', [None])[0])
+            if parts is None:
+                return self.reply(404, b'<Error><Code>NoSuchUpload</Code>'
+                                       b'</Error>')
+
+            if self.command == 'PUT':
+                number = int(params['partNumber'][0])
+                if server.failures.get(number):
+                    server.failures[number] -= 1
+                    return self.reply(500)
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                parts[number] = (etag, body)
+                return self.reply(200, headers={'ETag': etag})
+
+            if self.command == 'GET':
+                return self.reply(200, (
+                    '<ListPartsResult>%s<IsTruncated>false</IsTruncated>'
+                    '</ListPartsResult>' % ''.join(
+                        '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag>'
+                        '</Part>' % (number, etag)
+                        for number, (etag, _) in sorted(parts.items()))
+                ).encode())
+
+            if self.command == 'POST':
+                numbers = [int(part.text) for part in
+                           ElementTree.fromstring(body).iter('PartNumber')]
+                server.objects[url.path] = b''.join(
+                    parts[number][1] for number in numbers)
+                return self.reply(200, b'<CompleteMultipartUploadResult/>')
+
+    do_GET = do_PUT = do_POST = handle_request
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = S3StandIn()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'video.mp4')
+        self.content = os.urandom(2500)
+        with open(self.filepath, 'wb') as f:
+            f.write(self.content)
+        self.url = self.server.url + '/item/video.mp4'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def part_puts(self):
+        return [query for method, query in self.server.requests
+                if method == 'PUT']
+
+    def test_upload_in_parts(self):
+        upload = MultipartUpload(requests.Session(), self.url, self.filepath,
+                                 part_size=1000, workers=3)
+
+        upload.upload()
+
+        self.assertEqual(3, upload.part_count)
+        self.assertEqual(3, len(self.part_puts()))
+        self.assertEqual(self.content,
+                         self.server.objects['/item/video.mp4'])
+
+    def test_failing_part_is_retried_alone(self):
+        self.server.failures[2] = 2
+        upload = MultipartUpload(requests.Session(), self.url, self.filepath,
+                                 part_size=1000, retries=2, retry_delay=0)
+
+        upload.upload()
+
+        sent_parts = sorted(parse_qs(query)['partNumber'][0]
+                            for query in self.part_puts())
+        self.assertEqual(['1', '2', '2', '2', '3'], sent_parts)
+        self.assertEqual(self.content,
+                         self.server.objects['/item/video.mp4'])
+
+    def test_interrupted_upload_is_resumed(self):
+        store = MultipartUploads(os.path.join(self.tmpdir, 'uploads.sqlite3'))
+        self.server.failures[3] = 1
+        upload = MultipartUpload(requests.Session(), self.url, self.filepath,
+                                 part_size=1000, retries=0, store=store)
+
+        with self.assertRaises(requests.HTTPError):
+            upload.upload()
+        self.assertIsNotNone(store.get(self.url))
+
+        del self.server.requests[:]
+        upload.upload()
+
+        # Only the missing part has been sent again, to the same upload
+        self.assertEqual(['partNumber=3&uploadId=upload-1'],
+                         self.part_puts())
+        self.assertEqual(1, len(self.server.uploads))
+        self.assertEqual(self.content,
+                         self.server.objects['/item/video.mp4'])
+        self.assertIsNone(store.get(self.url))
+        store.close()
+
+    def test_unknown_upload_starts_again(self):
+        store = MultipartUploads(os.path.join(self.tmpdir, 'uploads.sqlite3'))
+        store.set(self.url, 'expired-upload', len(self.content),
+                  os.path.getmtime(self.filepath))
+        upload = MultipartUpload(requests.Session(), self.url, self.filepath,
+                                 part_size=1000, store=store)
+
+        upload.upload()
+
+        self.assertEqual(['upload-1'], list(self.server.uploads))
+        self.assertEqual(self.content,
+                         self.server.objects['/item/video.mp4'])
+        store.close()
+
+    def test_client_errors_are_not_retried(self):
+        upload = MultipartUpload(requests.Session(), self.url, self.filepath,
+                                 part_size=1000, retry_delay=0)
+
+        with self.assertRaises(requests.HTTPError):
+            upload.complete('missing-upload', {})
+        self.assertEqual(1, len(self.server.requests))
@@ -0,0 +1,211 @@
+import io
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import Mock, patch
+from tubeup.scheduling import (TokenBucket, ExtractorScheduler,
+                               BandwidthBudget, ThrottledReader,
+                               DiskSpaceGate,
+                               read_bandwidth_file, parse_extractor_limits)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_acquire_waits_for_tokens(self):
+        sleeps = []
+        with patch('tubeup.scheduling.time.monotonic', return_value=100), \
+                patch('tubeup.scheduling.time.sleep', side_effect=sleeps.append):
+            bucket = TokenBucket(rate=2)
+            for _ in range(3):
+                bucket.acquire()
+
+        # The first token is there already, the next ones are reserved
+        self.assertEqual([0.5, 1.0], sleeps)
+
+    def test_tokens_come_back(self):
+        sleeps = []
+        with patch('tubeup.scheduling.time.sleep', side_effect=sleeps.append):
+            with patch('tubeup.scheduling.time.monotonic', return_value=100):
+                bucket = TokenBucket(rate=2, capacity=2)
+                bucket.acquire()
+                bucket.acquire()
+            with patch('tubeup.scheduling.time.monotonic', return_value=101):
+                bucket.acquire()
+                bucket.acquire()
+
+        self.assertEqual([], sleeps)
+
+
+class ExtractorSchedulerTest(unittest.TestCase):
+
+    def test_slot_limits_concurrency_per_extractor(self):
+        scheduler = ExtractorScheduler({'Youtube': (2, None)})
+        lock = threading.Lock()
+        running = {'youtube': 0, 'soundcloud': 0}
+        most_running = {'youtube': 0, 'soundcloud': 0}
+
+        def call(extractor_key):
+            with scheduler.slot(extractor_key):
+                with lock:
+                    running[extractor_key.lower()] += 1
+                    most_running[extractor_key.lower()] = max(
+                        most_running[extractor_key.lower()],
+                        running[extractor_key.lower()])
+                time.sleep(0.05)
+                with lock:
+                    running[extractor_key.lower()] -= 1
+
+        threads = [threading.Thread(target=call, args=(extractor_key,))
+                   for extractor_key in ['youtube'] * 5 + ['Soundcloud'] * 5]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, most_running['youtube'])
+        # Extractors without limits aren't held back
+        self.assertEqual(5, most_running['soundcloud'])
+
+    def test_slot_without_extractor(self):
+        scheduler = ExtractorScheduler({'Youtube': (1, 1)})
+
+        with scheduler.slot(None):
+            pass
+
+    def test_parse_extractor_limits(self):
+        self.assertEqual(
+            {'Youtube': (2, 0.5), 'TwitchVod': (1, None),
+             'Soundcloud': (None, 2.0)},
+            parse_extractor_limits(['Youtube:2:0.5', 'TwitchVod:1',
+                                    'Soundcloud::2']))
+
+    def test_parse_invalid_extractor_limits(self):
+        for spec in ('Youtube', 'Youtube:two', ':2', 'Youtube:2:1:1'):
+            with self.assertRaisesRegex(ValueError,
+                                        r'^Invalid extractor limit'):
+                parse_extractor_limits([spec])
+
+
+class BandwidthBudgetTest(unittest.TestCase):
+
+    def test_adaptive_split(self):
+        budget = BandwidthBudget(limit=1200)
+        download_rates = []
+
+        with budget.transfer('download', on_rate=download_rates.append):
+            with budget.transfer('upload') as upload:
+                with budget.transfer('upload') as other_upload:
+                    self.assertEqual(400, upload.rate)
+                    self.assertEqual(400, other_upload.rate)
+                self.assertEqual(600, upload.rate)
+
+        self.assertEqual([1200, 600, 400, 600, 1200], download_rates)
+
+    def test_fixed_split(self):
+        budget = BandwidthBudget(limit=1000, download_share=0.75)
+
+        with budget.transfer('download') as download, \
+                budget.transfer('download') as other_download, \
+                budget.transfer('upload') as upload:
+            self.assertEqual(375, download.rate)
+            self.assertEqual(375, other_download.rate)
+            self.assertEqual(250, upload.rate)
+
+    def test_configure_changes_running_transfers(self):
+        budget = BandwidthBudget()
+        rates = []
+
+        with budget.transfer('download', on_rate=rates.append) as download:
+            budget.configure(limit=500)
+            self.assertEqual(500, download.rate)
+            budget.configure(limit=None)
+
+        self.assertEqual([None, 500, None], rates)
+
+    def test_invalid_share_and_stage(self):
+        with self.assertRaises(ValueError):
+            BandwidthBudget(limit=1000, download_share=2)
+        # Either stage would be left without any limit
+        for download_share in (0, 1):
+            with self.assertRaises(ValueError):
+                BandwidthBudget(limit=1000, download_share=download_share)
+        with self.assertRaises(ValueError):
+            with BandwidthBudget().transfer('extract'):
+                pass
+
+    def test_throttled_reader_paces_reads(self):
+        sleeps = []
+        budget = BandwidthBudget(limit=100)
+
+        with patch('tubeup.scheduling.time.monotonic', return_value=10), \
+                patch('tubeup.scheduling.time.sleep', side_effect=sleeps.append):
+            with budget.transfer('upload') as transfer:
+                reader = ThrottledReader(io.BytesIO(b'x' * 150), transfer)
+                self.assertEqual(b'x' * 50, reader.read(50))
+                self.assertEqual(b'x' * 100, reader.read())
+                self.assertEqual(b'', reader.read())
+
+        self.assertEqual([0.5, 1.5], sleeps)
+
+    def test_read_bandwidth_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'bandwidth')
+            for content, expected in (('10M\n', (10485760, None)),
+                                      ('2K 0.25', (2048, 0.25)),
+                                      ('none 0.5', (None, 0.5))):
+                with open(filepath, 'w') as f:
+                    f.write(content)
+                self.assertEqual(expected, read_bandwidth_file(filepath))
+
+            with open(filepath, 'w') as f:
+                f.write('fast')
+            with self.assertRaisesRegex(ValueError, 'invalid limit'):
+                read_bandwidth_file(filepath)
+
+
+class DiskSpaceGateTest(unittest.TestCase):
+
+    def disk_usage(self, free):
+        return patch('tubeup.scheduling.shutil.disk_usage',
+                     return_value=Mock(free=free))
+
+    def test_reserve_counts_running_downloads(self):
+        gate = DiskSpaceGate(min_free=100, poll_interval=0.01)
+
+        with self.disk_usage(1000):
+            with gate.reserve('/', 500) as admitted:
+                self.assertTrue(admitted)
+                # 500 bytes are taken by the running download
+                with gate.reserve('/', 300) as other_admitted:
+                    self.assertTrue(other_admitted)
+
+    def test_reserve_turns_down_when_nothing_frees_space(self):
+        gate = DiskSpaceGate(min_free=100)
+
+        with self.disk_usage(500), gate.reserve('/', 450) as admitted:
+            self.assertFalse(admitted)
+
+    def test_reserve_waits_for_uploads(self):
+        gate = DiskSpaceGate(min_free=100, poll_interval=0.01)
+        free = {'bytes': 200}
+        gate.expect_free('video')
+
+        def upload():
+            time.sleep(0.05)
+            free['bytes'] = 1000
+            gate.freed('video')
+
+        thread = threading.Thread(target=upload)
+        thread.start()
+        with patch('tubeup.scheduling.shutil.disk_usage',
+                   side_effect=lambda path: Mock(free=free['bytes'])):
+            with gate.reserve('/', 500) as admitted:
+                self.assertTrue(admitted)
+        thread.join()
+
+    def test_disabled_gate(self):
+        with DiskSpaceGate().reserve('/', 10 ** 18) as admitted:
+            self.assertTrue(admitted)
@@ -0,0 +1,270 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from tubeup.state import (ItemExistenceCache, DownloadArchive, JobStore,
+                          JobQueue, SyncMarks, BatchCheckpoints,
+                          MultipartUploads)
+
+
+class ItemExistenceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ItemExistenceCache(
+            os.path.join(self.tmpdir, 'cache.sqlite3'), missing_ttl=60)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_unknown_item(self):
+        self.assertIsNone(self.cache.get('youtube-KdsN9YhkDrY'))
+
+    def test_existing_item_never_expires(self):
+        self.cache.set('youtube-6iRV8liah8A', True)
+
+        with patch('tubeup.state.time.time', return_value=1e12):
+            self.assertTrue(self.cache.get('youtube-6iRV8liah8A'))
+
+    def test_missing_item_expires(self):
+        with patch('tubeup.state.time.time', return_value=1000):
+            self.cache.set('youtube-KdsN9YhkDrY', False)
+
+        with patch('tubeup.state.time.time', return_value=1059):
+            self.assertIs(False, self.cache.get('youtube-KdsN9YhkDrY'))
+        with patch('tubeup.state.time.time', return_value=1061):
+            self.assertIsNone(self.cache.get('youtube-KdsN9YhkDrY'))
+
+    def test_cache_is_shared_between_connections(self):
+        self.cache.set('youtube-6iRV8liah8A', True)
+
+        other_cache = ItemExistenceCache(self.cache.path)
+        self.assertTrue(other_cache.get('youtube-6iRV8liah8A'))
+        other_cache.close()
+
+
+class DownloadArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = DownloadArchive(
+            os.path.join(self.tmpdir, 'archive.sqlite3'))
+        self.text_archive_path = os.path.join(self.tmpdir, '.ytdlarchive')
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_add(self):
+        self.assertNotIn('youtube KdsN9YhkDrY', self.archive)
+
+        self.archive.add('youtube KdsN9YhkDrY')
+        self.archive.add('youtube KdsN9YhkDrY')
+
+        self.assertIn('youtube KdsN9YhkDrY', self.archive)
+        self.assertTrue(self.archive)
+
+    def test_import_file(self):
+        with open(self.text_archive_path, 'w') as f:
+            f.write('youtube KdsN9YhkDrY\n\nyoutube 6iRV8liah8A\n')
+
+        self.assertEqual(self.archive.import_file(self.text_archive_path), 2)
+        self.assertIn('youtube KdsN9YhkDrY', self.archive)
+        self.assertIn('youtube 6iRV8liah8A', self.archive)
+
+    def test_import_file_only_when_modified(self):
+        with open(self.text_archive_path, 'w') as f:
+            f.write('youtube KdsN9YhkDrY\n')
+        self.archive.import_file(self.text_archive_path)
+
+        self.assertEqual(self.archive.import_file(self.text_archive_path), 0)
+
+        with open(self.text_archive_path, 'a') as f:
+            f.write('youtube 6iRV8liah8A\n')
+        os.utime(self.text_archive_path, (0, 0))
+        self.assertEqual(self.archive.import_file(self.text_archive_path), 1)
+
+    def test_import_missing_file(self):
+        self.assertEqual(self.archive.import_file(self.text_archive_path), 0)
+
+    def test_archive_is_shared_between_connections(self):
+        self.archive.add('youtube 6iRV8liah8A')
+
+        other_archive = DownloadArchive(self.archive.path)
+        self.assertIn('youtube 6iRV8liah8A', other_archive)
+        other_archive.close()
+
+
+class JobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.jobs = JobStore(os.path.join(self.tmpdir, 'jobs.sqlite3'))
+
+    def tearDown(self):
+        self.jobs.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_unknown_job(self):
+        self.assertIsNone(self.jobs.get('youtube-KdsN9YhkDrY'))
+
+    def test_set_state_keeps_basename(self):
+        self.jobs.set_state('youtube-KdsN9YhkDrY', 'discovered')
+        self.jobs.set_state('youtube-KdsN9YhkDrY', 'downloaded',
+                            '/downloads/KdsN9YhkDrY')
+        self.jobs.set_state('youtube-KdsN9YhkDrY', 'uploaded')
+
+        self.assertEqual(('uploaded', '/downloads/KdsN9YhkDrY'),
+                         self.jobs.get('youtube-KdsN9YhkDrY'))
+
+    def test_unknown_state(self):
+        with self.assertRaises(ValueError):
+            self.jobs.set_state('youtube-KdsN9YhkDrY', 'lost')
+
+    def test_fail_basename(self):
+        self.jobs.set_state('youtube-KdsN9YhkDrY', 'downloaded',
+                            '/downloads/KdsN9YhkDrY')
+
+        self.jobs.fail_basename('/downloads/KdsN9YhkDrY', 'Upload refused')
+
+        self.assertEqual(('failed', '/downloads/KdsN9YhkDrY'),
+                         self.jobs.get('youtube-KdsN9YhkDrY'))
+        self.assertEqual(
+            [('Upload refused',)],
+            self.jobs.execute('SELECT reason FROM jobs'))
+
+    def test_jobs_in_state(self):
+        self.jobs.set_state('youtube-KdsN9YhkDrY', 'downloaded',
+                            '/downloads/KdsN9YhkDrY')
+        self.jobs.set_state('youtube-6iRV8liah8A', 'verified',
+                            '/downloads/6iRV8liah8A')
+
+        self.assertEqual([('youtube-KdsN9YhkDrY', '/downloads/KdsN9YhkDrY')],
+                         self.jobs.jobs_in_state('downloaded'))
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = JobQueue(os.path.join(self.tmpdir, 'queue.sqlite3'))
+        self.queue.enqueue(['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+                            'https://www.youtube.com/watch?v=6iRV8liah8A'])
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_enqueue_ignores_queued_urls(self):
+        self.assertEqual(1, self.queue.enqueue(
+            ['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+             'https://www.youtube.com/watch?v=Zb9nE_mWVus']))
+        self.assertEqual({'pending': 3}, self.queue.counts())
+
+    def test_claim_hands_every_url_once(self):
+        other_queue = JobQueue(self.queue.path)
+
+        first = self.queue.claim('worker-1', 60)
+        second = other_queue.claim('worker-2', 60)
+        other_queue.close()
+
+        self.assertEqual('https://www.youtube.com/watch?v=KdsN9YhkDrY',
+                         first[1])
+        self.assertEqual('https://www.youtube.com/watch?v=6iRV8liah8A',
+                         second[1])
+        self.assertIsNone(self.queue.claim('worker-3', 60))
+
+    def test_expired_lease_is_reclaimed(self):
+        with patch('tubeup.state.time.time', return_value=1000):
+            job_id, url = self.queue.claim('worker-1', 60)
+            other_job = self.queue.claim('worker-1', 60)
+
+        # Only the lease of the first url is renewed
+        with patch('tubeup.state.time.time', return_value=1030):
+            self.assertTrue(self.queue.heartbeat(job_id, 'worker-1', 60))
+        with patch('tubeup.state.time.time', return_value=1089):
+            self.assertEqual(other_job, self.queue.claim('worker-2', 60))
+            self.assertIsNone(self.queue.claim('worker-2', 60))
+        with patch('tubeup.state.time.time', return_value=1091):
+            self.assertEqual((job_id, url), self.queue.claim('worker-2', 60))
+
+            # The dead worker can't keep or complete the url anymore
+            self.assertFalse(self.queue.heartbeat(job_id, 'worker-1', 60))
+            self.queue.complete(job_id, 'worker-1')
+            self.assertEqual({'leased': 2}, self.queue.counts())
+
+    def test_complete_and_fail(self):
+        first_id, _ = self.queue.claim('worker-1', 60)
+        second_id, _ = self.queue.claim('worker-1', 60)
+
+        self.queue.complete(first_id, 'worker-1')
+        self.queue.fail(second_id, 'worker-1', 'Video unavailable')
+
+        self.assertEqual({'done': 1, 'failed': 1}, self.queue.counts())
+        self.assertIsNone(self.queue.claim('worker-1', 60))
+
+
+class SyncMarksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.marks = SyncMarks(os.path.join(self.tmpdir, 'marks.sqlite3'))
+
+    def tearDown(self):
+        self.marks.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_mark(self):
+        self.assertIsNone(self.marks.get('YoutubeTab:UCWpsozCMdAnfI16rZHQ9XDg'))
+
+        self.marks.set('YoutubeTab:UCWpsozCMdAnfI16rZHQ9XDg', '6iRV8liah8A')
+        self.marks.set('YoutubeTab:UCWpsozCMdAnfI16rZHQ9XDg', 'KdsN9YhkDrY',
+                       '20160625')
+
+        self.assertEqual(('KdsN9YhkDrY', '20160625'),
+                         self.marks.get('YoutubeTab:UCWpsozCMdAnfI16rZHQ9XDg'))
+
+
+class BatchCheckpointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoints = BatchCheckpoints(
+            os.path.join(self.tmpdir, 'batches.sqlite3'))
+
+    def tearDown(self):
+        self.checkpoints.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_checkpoint(self):
+        self.assertEqual(0, self.checkpoints.get('/batches/urls.txt'))
+
+        self.checkpoints.set('/batches/urls.txt', 54)
+
+        self.assertEqual(54, self.checkpoints.get('/batches/urls.txt'))
+
+
+class MultipartUploadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uploads = MultipartUploads(
+            os.path.join(self.tmpdir, 'multipart.sqlite3'))
+
+    def tearDown(self):
+        self.uploads.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upload(self):
+        url = 'https://s3.us.archive.org/item/video.mp4'
+        self.assertIsNone(self.uploads.get(url))
+
+        self.uploads.set(url, 'upload-id', 2500, 1700000000.5)
+        self.assertEqual(('upload-id', 2500, 1700000000.5),
+                         tuple(self.uploads.get(url)))
+
+        self.uploads.delete(url)
+        self.assertIsNone(self.uploads.get(url))
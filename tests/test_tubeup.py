@@ -1,23 +1,42 @@
+import io
+import sys
 import unittest
 import os
 import shutil
 import json
 import time
+import requests
 import requests_mock
 import glob
 import logging
+import threading
+import sqlite3
 
-from tubeup.TubeUp import TubeUp, DOWNLOAD_DIR_NAME
+from tubeup.TubeUp import TubeUp, DOWNLOAD_DIR_NAME, MultipartUploadInterrupted
+from tubeup.state import DownloadArchive, JobQueue
 from tubeup import __version__
 from yt_dlp import YoutubeDL
 from .constants import info_dict_playlist, info_dict_video
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 
 SCANNER = 'TubeUp Video Stream Mirroring Application {}'.format(__version__)
 
+FLAT_PLAYLIST_URL = 'https://www.youtube.com/playlist?list=PLtestplaylist'
+
+CHANNEL_URL = 'https://www.youtube.com/@testchannel'
+
+# The videos listed by every tab of the channel
+CHANNEL_TABS = {
+    CHANNEL_URL + '/videos': ('KdsN9YhkDrY', '6iRV8liah8A'),
+    CHANNEL_URL + '/shorts': ('6iRV8liah8A',),
+}
+
+# The ids of the tab entries that have been walked
+walked_tab_entries = []
+
 
 def get_testfile_path(name):
     return os.path.join(current_path, 'test_tubeup_files', name)
@@ -37,6 +56,11 @@ def mock_upload_response_by_videobasename(m, ia_id, videobasename):
               headers={'content-type': 'text/plain'})
 
 
+def get_job_dir_name(filename):
+    video_id = '6iRV8liah8A' if '6iRV8liah8A' in filename else 'KdsN9YhkDrY'
+    return 'youtube-%s' % video_id
+
+
 def copy_testfiles_to_tubeup_rootdir_test():
     # Copy testfiles to rootdir path of TubeUp.
     # This method was created because after the uploading done by
@@ -45,21 +69,69 @@ def copy_testfiles_to_tubeup_rootdir_test():
                                  'files_for_upload_and_download_tests')
 
     for filepath in os.listdir(testfiles_dir):
-        shutil.copy(
-            os.path.join(testfiles_dir, filepath),
-            os.path.join(current_path, 'test_tubeup_rootdir', 'downloads',
-                         filepath))
+        # Every video is downloaded into its own job directory
+        job_dir = os.path.join(current_path, 'test_tubeup_rootdir',
+                               'downloads', get_job_dir_name(filepath))
+        os.makedirs(job_dir, exist_ok=True)
+        shutil.copy(os.path.join(testfiles_dir, filepath),
+                    os.path.join(job_dir, filepath))
 
 
 # Hijacked yt-dlp class so we don't make any real download requests.
 class MockYTDLP(YoutubeDL):
-    def extract_info(self, url, download=True):
+    def extract_info(self, url, download=True, ie_key=None, extra_info=None,
+                     process=True, force_generic_extractor=False):
         filenames = {
             "https://www.youtube.com/watch?v=KdsN9YhkDrY": "KdsN9YhkDrY.info.json",
+            "https://www.youtube.com/watch?v=6iRV8liah8A":
+                "Mountain_3_-_Video_Background_HD_1080p-6iRV8liah8A.info.json",
         }
 
         print("MockYTDLP: Mocked yt-dlp info extraction of URL %s" % (url))
 
+        if url == FLAT_PLAYLIST_URL:
+            return {
+                '_type': 'playlist',
+                'id': 'PLtestplaylist',
+                'extractor': 'youtube:tab',
+                'extractor_key': 'YoutubeTab',
+                'channel_url': 'https://www.youtube.com/channel/UCtestchannel',
+                # A generator, like the entries of a YouTube channel
+                'entries': (
+                    {'_type': 'url', 'ie_key': 'Youtube', 'id': video_id,
+                     'url': 'https://www.youtube.com/watch?v=%s' % video_id}
+                    for video_id in ('KdsN9YhkDrY', '6iRV8liah8A')),
+            }
+
+        if url == CHANNEL_URL:
+            return {
+                '_type': 'playlist',
+                'id': 'UCtestchannel',
+                'extractor': 'youtube:tab',
+                'extractor_key': 'YoutubeTab',
+                'webpage_url': url,
+                'entries': [{'_type': 'url', 'ie_key': 'YoutubeTab',
+                             'url': tab_url} for tab_url in CHANNEL_TABS],
+            }
+
+        if url in CHANNEL_TABS:
+            def iter_tab_entries():
+                for video_id in CHANNEL_TABS[url]:
+                    walked_tab_entries.append(video_id)
+                    yield {'_type': 'url', 'ie_key': 'Youtube',
+                           'id': video_id,
+                           'url': 'https://www.youtube.com/watch?v=%s' % video_id}
+
+            return {
+                '_type': 'playlist',
+                # Like the tabs of a YouTube channel, the id of the channel
+                'id': 'UCtestchannel',
+                'extractor': 'youtube:tab',
+                'extractor_key': 'YoutubeTab',
+                'webpage_url': url,
+                'entries': iter_tab_entries(),
+            }
+
         # make sure the url is one we expect to get. If the tests URL ever
         # change for some reason, this will fail, and we can add new cases
         # if needed.
@@ -67,10 +139,20 @@ class MockYTDLP(YoutubeDL):
             raise ValueError("unexpected URL")
 
         jsonpath = os.path.join(current_path, 'test_tubeup_rootdir',
-                                'downloads', filenames[url])
+                                'downloads', get_job_dir_name(filenames[url]),
+                                filenames[url])
         with open(jsonpath, "r") as f:
             return json.load(f)
 
+    def process_ie_result(self, ie_result, download=True, extra_info=None):
+        print("MockYTDLP: Mocked yt-dlp processing of %s" % ie_result['id'])
+        return ie_result
+
+    def process_info(self, info_dict):
+        print("MockYTDLP: Mocked yt-dlp download of %s" % info_dict['id'])
+        # Like yt-dlp, which leaves the recording to its caller
+        info_dict['__write_download_archive'] = True
+
 
 @patch("tubeup.TubeUp.YoutubeDL", MockYTDLP)
 class TubeUpTests(unittest.TestCase):
@@ -79,6 +161,10 @@ class TubeUpTests(unittest.TestCase):
         self.tu = TubeUp()
         self.maxDiff = 999999999
 
+        # Start every test without the state left by the previous ones
+        shutil.rmtree(os.path.join(current_path, 'test_tubeup_rootdir'),
+                      ignore_errors=True)
+
     def test_set_dir_path(self):
         root_path = os.path.join(
             current_path, '.directory_for_tubeup_set_dir_path_test')
@@ -150,7 +236,8 @@ class TubeUpTests(unittest.TestCase):
 
         expected_result = {
             'outtmpl': os.path.join(
-                self.tu.dir_path['downloads'], '%(id)s.%(ext)s'),
+                self.tu.dir_path['downloads'], '%(extractor)s-%(id)s',
+                '%(id)s.%(ext)s'),
             'restrictfilenames': True,
             'verbose': False,
             'quiet': True,
@@ -175,16 +262,41 @@ class TubeUpTests(unittest.TestCase):
             'prefer_ffmpeg': True,
             'call_home': False,
             'logger': self.tu.logger,
-            'progress_hooks': [mocked_ydl_progress_hook]}
+            'progress_hooks': [mocked_ydl_progress_hook,
+                               self.tu.record_downloaded_file],
+            'postprocessor_hooks': [self.tu.record_postprocessed_files]}
 
         self.assertEqual(result, expected_result)
 
+    def test_generate_ydl_options_with_sqlite_download_archive(self):
+        tu = TubeUp(dir_path=os.path.join(current_path, 'test_tubeup_rootdir'),
+                    download_archive_backend='sqlite')
+        with open(os.path.join(tu.dir_path['root'], '.ytdlarchive'),
+                  'w') as f:
+            f.write('youtube KdsN9YhkDrY\n')
+
+        result = tu.generate_ydl_options(mocked_ydl_progress_hook,
+                                         use_download_archive=True)
+
+        archive = result['download_archive']
+        self.assertIsInstance(archive, DownloadArchive)
+        self.assertEqual(archive.path, os.path.join(
+            tu.dir_path['root'], '.ytdlarchive.sqlite3'))
+        self.assertIn('youtube KdsN9YhkDrY', archive)
+        self.assertNotIn('youtube 6iRV8liah8A', archive)
+        archive.close()
+
+    def test_unknown_download_archive_backend(self):
+        with self.assertRaises(ValueError):
+            TubeUp(download_archive_backend='csv')
+
     def test_generate_ydl_options(self):
         result = self.tu.generate_ydl_options(mocked_ydl_progress_hook)
 
         expected_result = {
             'outtmpl': os.path.join(
-                self.tu.dir_path['downloads'], '%(id)s.%(ext)s'),
+                self.tu.dir_path['downloads'], '%(extractor)s-%(id)s',
+                '%(id)s.%(ext)s'),
             'restrictfilenames': True,
             'verbose': False,
             'quiet': True,
@@ -207,7 +319,9 @@ class TubeUpTests(unittest.TestCase):
             'prefer_ffmpeg': True,
             'call_home': False,
             'logger': self.tu.logger,
-            'progress_hooks': [mocked_ydl_progress_hook]}
+            'progress_hooks': [mocked_ydl_progress_hook,
+                               self.tu.record_downloaded_file],
+            'postprocessor_hooks': [self.tu.record_postprocessed_files]}
 
         self.assertEqual(result, expected_result)
 
@@ -217,7 +331,8 @@ class TubeUpTests(unittest.TestCase):
 
         expected_result = {
             'outtmpl': os.path.join(
-                self.tu.dir_path['downloads'], '%(id)s.%(ext)s'),
+                self.tu.dir_path['downloads'], '%(extractor)s-%(id)s',
+                '%(id)s.%(ext)s'),
             'restrictfilenames': True,
             'verbose': False,
             'quiet': True,
@@ -240,7 +355,9 @@ class TubeUpTests(unittest.TestCase):
             'prefer_ffmpeg': True,
             'call_home': False,
             'logger': self.tu.logger,
-            'progress_hooks': [mocked_ydl_progress_hook],
+            'progress_hooks': [mocked_ydl_progress_hook,
+                               self.tu.record_downloaded_file],
+            'postprocessor_hooks': [self.tu.record_postprocessed_files],
             'proxy': 'http://proxytest.com:8080'}
 
         self.assertEqual(result, expected_result)
@@ -252,7 +369,8 @@ class TubeUpTests(unittest.TestCase):
 
         expected_result = {
             'outtmpl': os.path.join(
-                self.tu.dir_path['downloads'], '%(id)s.%(ext)s'),
+                self.tu.dir_path['downloads'], '%(extractor)s-%(id)s',
+                '%(id)s.%(ext)s'),
             'restrictfilenames': True,
             'verbose': False,
             'quiet': True,
@@ -275,7 +393,9 @@ class TubeUpTests(unittest.TestCase):
             'prefer_ffmpeg': True,
             'call_home': False,
             'logger': self.tu.logger,
-            'progress_hooks': [mocked_ydl_progress_hook],
+            'progress_hooks': [mocked_ydl_progress_hook,
+                               self.tu.record_downloaded_file],
+            'postprocessor_hooks': [self.tu.record_postprocessed_files],
             'username': 'testUsername',
             'password': 'testPassword'}
 
@@ -289,7 +409,8 @@ class TubeUpTests(unittest.TestCase):
 
         expected_result = {
             'outtmpl': os.path.join(
-                self.tu.dir_path['downloads'], '%(id)s.%(ext)s'),
+                self.tu.dir_path['downloads'], '%(extractor)s-%(id)s',
+                '%(id)s.%(ext)s'),
             'restrictfilenames': True,
             'verbose': True,
             'quiet': False,
@@ -312,7 +433,9 @@ class TubeUpTests(unittest.TestCase):
             'prefer_ffmpeg': True,
             'call_home': False,
             'logger': tu.logger,
-            'progress_hooks': [mocked_ydl_progress_hook],
+            'progress_hooks': [mocked_ydl_progress_hook,
+                               tu.record_downloaded_file],
+            'postprocessor_hooks': [tu.record_postprocessed_files],
             'username': 'testUsername',
             'password': 'testPassword'}
 
@@ -491,9 +614,483 @@ class TubeUpTests(unittest.TestCase):
 
         expected_result = {os.path.join(
             current_path, 'test_tubeup_rootdir', 'downloads',
-            'KdsN9YhkDrY')}
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')}
+
+        self.assertEqual(expected_result, result)
+
+    def test_get_resource_basenames_with_download_archive(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        tu.get_resource_basenames(
+            ['https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+            ignore_existing_item=True, use_download_archive=True)
+
+        with open(tu.download_archive) as f:
+            self.assertEqual('youtube KdsN9YhkDrY\n', f.read())
+
+    def test_get_resource_basenames_with_basename_callback(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        reported_basenames = []
+        result = tu.get_resource_basenames(
+            ['https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+            ignore_existing_item=True,
+            basename_callback=reported_basenames.append)
+
+        self.assertEqual(list(result), reported_basenames)
+
+    def test_get_resource_basenames_extracts_each_video_once(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m, \
+                patch.object(MockYTDLP, 'extract_info', autospec=True,
+                             side_effect=MockYTDLP.extract_info) as extract_info:
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            result = tu.get_resource_basenames(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY'])
+
+        expected_result = {os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')}
+
+        self.assertEqual(expected_result, result)
+        self.assertEqual(1, extract_info.call_count)
+
+    def test_get_resource_basenames_skips_duplicate_urls(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m, \
+                patch.object(MockYTDLP, 'extract_info', autospec=True,
+                             side_effect=MockYTDLP.extract_info) as extract_info, \
+                patch('sys.stdout', new_callable=io.StringIO):
+            tu.verbose = True
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-6iRV8liah8A/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            result = tu.get_resource_basenames(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+                 'https://www.youtube.com/watch?v=KdsN9YhkDrY&t=10',
+                 'https://youtu.be/KdsN9YhkDrY',
+                 # Overlaps with the first url
+                 FLAT_PLAYLIST_URL])
+            output = sys.stdout.getvalue()
+
+        self.assertEqual(2, len(result))
+        # Once for every video and once for the playlist
+        self.assertEqual(
+            ['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+             FLAT_PLAYLIST_URL,
+             'https://www.youtube.com/watch?v=6iRV8liah8A'],
+            [call.args[1] for call in extract_info.call_args_list])
+        self.assertIn(':: Skipped 3 duplicate url(s) and playlist entries',
+                      output)
+
+    def test_get_resource_basenames_keeps_tabs_of_a_channel(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        tu.item_cache.set('youtube-KdsN9YhkDrY', True)
+        tu.item_cache.set('youtube-6iRV8liah8A', True)
+
+        with patch.object(MockYTDLP, 'extract_info', autospec=True,
+                          side_effect=MockYTDLP.extract_info) as extract_info:
+            tu.get_resource_basenames([CHANNEL_URL + '/videos',
+                                       CHANNEL_URL + '/shorts',
+                                       CHANNEL_URL + '/videos'])
+
+        # Both tabs have the id of the channel, only the repeated url is
+        # a duplicate.
+        self.assertEqual([CHANNEL_URL + '/videos', CHANNEL_URL + '/shorts'],
+                         [call.args[1] for call in extract_info.call_args_list])
+
+    def test_get_resource_basenames_with_flat_playlist(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m, \
+                patch.object(MockYTDLP, 'extract_info', autospec=True,
+                             side_effect=MockYTDLP.extract_info) as extract_info:
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-6iRV8liah8A/metadata/identifier',
+                  content=b'{"result": "youtube-6iRV8liah8A"}',
+                  headers={'content-type': 'application/json'})
+
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL],
+                                               flat_playlist=True)
+
+        expected_result = {os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')}
+
+        self.assertEqual(expected_result, result)
+        # The video that is already on archive.org is never extracted
+        self.assertEqual(
+            [FLAT_PLAYLIST_URL, 'https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+            [call.args[1] for call in extract_info.call_args_list])
+
+    def test_get_resource_basenames_skips_items_known_to_exist(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    preflight_workers=0)
+        # Found on archive.org by an earlier run
+        tu.item_cache.set('youtube-6iRV8liah8A', True)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m, \
+                patch.object(MockYTDLP, 'extract_info', autospec=True,
+                             side_effect=MockYTDLP.extract_info) as extract_info:
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL])
+
+        self.assertEqual(1, len(result))
+        # Without flat_playlist, only the video not known to exist is
+        # extracted before being checked.
+        self.assertEqual(
+            [FLAT_PLAYLIST_URL, 'https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+            [call.args[1] for call in extract_info.call_args_list])
+
+    def test_get_resource_basenames_handles_playlist_entries_one_by_one(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        calls = []
+        mocked_extract_info = MockYTDLP.extract_info
+
+        def extract_info(ydl, url, *args, **kwargs):
+            calls.append(('extract', url))
+            return mocked_extract_info(ydl, url, *args, **kwargs)
+
+        def process_ie_result(ydl, ie_result, *args, **kwargs):
+            calls.append(('process', ie_result['id']))
+            return ie_result
+
+        def process_info(ydl, info_dict):
+            calls.append(('download', info_dict['id']))
+
+        with patch.object(MockYTDLP, 'extract_info', extract_info), \
+                patch.object(MockYTDLP, 'process_ie_result', process_ie_result), \
+                patch.object(MockYTDLP, 'process_info', process_info):
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL],
+                                               ignore_existing_item=True)
+
+        self.assertEqual(2, len(result))
+        # Every entry is downloaded before the next one gets extracted
+        self.assertEqual(
+            [('extract', FLAT_PLAYLIST_URL),
+             ('extract', 'https://www.youtube.com/watch?v=KdsN9YhkDrY'),
+             ('process', 'KdsN9YhkDrY'),
+             ('download', 'KdsN9YhkDrY'),
+             ('extract', 'https://www.youtube.com/watch?v=6iRV8liah8A'),
+             ('process', '6iRV8liah8A'),
+             ('download', '6iRV8liah8A')],
+            calls)
+
+    def test_get_resource_basenames_with_preflight_checks(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    preflight_workers=2)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        checking_threads = {}
+
+        def ia_item_exists(itemname):
+            checking_threads[itemname] = threading.current_thread()
+            return itemname == 'youtube-6iRV8liah8A'
+
+        with patch.object(tu, 'ia_item_exists', side_effect=ia_item_exists) as exists:
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL])
+
+        expected_result = {os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')}
+
+        self.assertEqual(expected_result, result)
+        # Both entries were checked once, ahead of their download and off
+        # the downloading thread.
+        self.assertEqual(2, exists.call_count)
+        self.assertEqual({'youtube-KdsN9YhkDrY', 'youtube-6iRV8liah8A'},
+                         set(checking_threads))
+        self.assertNotIn(threading.current_thread(),
+                         checking_threads.values())
+
+    def test_ia_item_exists_is_cached(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        with requests_mock.Mocker() as m:
+            m.get('https://archive.org/metadata/youtube-6iRV8liah8A/metadata/identifier',
+                  content=b'{"result": "youtube-6iRV8liah8A"}',
+                  headers={'content-type': 'application/json'})
+
+            self.assertTrue(tu.ia_item_exists('youtube-6iRV8liah8A'))
+
+        # A new instance, like the next run, doesn't ask archive.org again
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        with requests_mock.Mocker() as m:
+            self.assertTrue(tu.ia_item_exists('youtube-6iRV8liah8A'))
+            self.assertEqual(0, m.call_count)
+
+    def test_build_channel_query(self):
+        self.assertEqual(
+            'channel:"http://www.youtube.com/channel/UCtestchannel" OR '
+            'channel:"https://www.youtube.com/channel/UCtestchannel"',
+            TubeUp.build_channel_query(
+                {'channel_url': 'https://www.youtube.com/channel/UCtestchannel'}))
+        self.assertIsNone(TubeUp.build_channel_query({'id': 'PLtestplaylist'}))
+
+    def test_get_resource_basenames_with_bulk_prefetch(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    bulk_prefetch=True)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m:
+            m.post('https://archive.org/services/search/v1/scrape',
+                   json={'items': [{'identifier': 'youtube-6iRV8liah8A'}],
+                         'count': 1, 'total': 1})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL])
+
+            requested_urls = [r.url.split('?')[0] for r in m.request_history]
+
+        expected_result = {os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')}
 
         self.assertEqual(expected_result, result)
+        # Only the video missing from the search results was checked alone
+        self.assertEqual(
+            ['https://archive.org/services/search/v1/scrape',
+             'https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier'],
+            requested_urls)
+
+    def test_get_resource_basenames_with_incremental_sync(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    preflight_workers=0,
+                    incremental_sync=True)
+        # The newest video isn't archived yet
+        tu.item_cache.set('youtube-KdsN9YhkDrY', False)
+        tu.item_cache.set('youtube-6iRV8liah8A', True)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        def sync():
+            with patch.object(MockYTDLP, 'extract_info', autospec=True,
+                              side_effect=MockYTDLP.extract_info) as extract_info:
+                tu.get_resource_basenames([FLAT_PLAYLIST_URL])
+            return [call.args[1] for call in extract_info.call_args_list]
+
+        # The video known to exist isn't extracted
+        self.assertEqual([FLAT_PLAYLIST_URL,
+                          'https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+                         sync())
+        self.assertEqual(('6iRV8liah8A', None),
+                         tu.sync_marks.get('YoutubeTab:PLtestplaylist'))
+
+        # The walk stops at the mark, the newest video is skipped with its
+        # job and becomes the new mark once it has been uploaded.
+        tu.job_store.set_state('youtube-KdsN9YhkDrY', 'uploaded')
+        tu.item_cache.set('youtube-KdsN9YhkDrY', True)
+        self.assertEqual([FLAT_PLAYLIST_URL], sync())
+        self.assertEqual(('KdsN9YhkDrY', None),
+                         tu.sync_marks.get('YoutubeTab:PLtestplaylist'))
+
+        # Even without its job the newest video isn't walked anymore
+        tu.job_store.execute('DELETE FROM jobs')
+        self.assertEqual([FLAT_PLAYLIST_URL], sync())
+
+    def test_get_resource_basenames_with_incremental_sync_of_channel_tabs(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    incremental_sync=True)
+        tu.item_cache.set('youtube-KdsN9YhkDrY', True)
+        tu.item_cache.set('youtube-6iRV8liah8A', True)
+
+        del walked_tab_entries[:]
+        tu.get_resource_basenames([CHANNEL_URL])
+        self.assertEqual(['KdsN9YhkDrY', '6iRV8liah8A', '6iRV8liah8A'],
+                         walked_tab_entries)
+        # Every tab has its own mark
+        self.assertEqual(('KdsN9YhkDrY', None),
+                         tu.sync_marks.get('YoutubeTab:%s/videos' % CHANNEL_URL))
+        self.assertEqual(('6iRV8liah8A', None),
+                         tu.sync_marks.get('YoutubeTab:%s/shorts' % CHANNEL_URL))
+
+        # The next sync stops at the mark of every tab
+        del walked_tab_entries[:]
+        tu.get_resource_basenames([CHANNEL_URL])
+        self.assertEqual(['KdsN9YhkDrY', '6iRV8liah8A'], walked_tab_entries)
+
+    def test_get_resource_basenames_with_download_workers(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    download_workers=2)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m:
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            result = tu.get_resource_basenames(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY'])
+
+        expected_result = {os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')}
+
+        self.assertEqual(expected_result, result)
+
+    def test_get_resource_basenames_with_extractor_limits(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    download_workers=2,
+                    extractor_limits={'Youtube': (1, None)})
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        lock = threading.Lock()
+        downloads = {'running': 0, 'most_running': 0}
+
+        def download(ydl, info_dict):
+            with lock:
+                downloads['running'] += 1
+                downloads['most_running'] = max(downloads['most_running'],
+                                                downloads['running'])
+            time.sleep(0.05)
+            with lock:
+                downloads['running'] -= 1
+
+        slot = tu.scheduler.slot
+        slot_keys = []
+
+        def record_slot(extractor_key):
+            slot_keys.append(extractor_key)
+            return slot(extractor_key)
+
+        with patch.object(MockYTDLP, 'process_info', autospec=True,
+                          side_effect=download), \
+                patch.object(tu.scheduler, 'slot', side_effect=record_slot):
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL],
+                                               ignore_existing_item=True)
+
+        self.assertEqual(2, len(result))
+        self.assertEqual(1, downloads['most_running'])
+        # The playlist, then an extraction and a download for every video
+        self.assertEqual(['YoutubeTab'] + ['Youtube'] * 4, slot_keys)
+
+    def test_get_resource_basenames_with_bandwidth_limit(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    bandwidth_limit=1000)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        ratelimits = []
+
+        def download(ydl, info_dict):
+            ratelimits.append(ydl.params.get('ratelimit'))
+
+        with patch.object(MockYTDLP, 'process_info', autospec=True,
+                          side_effect=download):
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL],
+                                               ignore_existing_item=True)
+
+        self.assertEqual(2, len(result))
+        self.assertEqual([1000, 1000], ratelimits)
+
+    def test_get_resource_basenames_without_disk_space(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    min_free_space=10 ** 18)
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with patch.object(MockYTDLP, 'process_info') as process_info:
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL],
+                                               ignore_existing_item=True)
+
+        self.assertEqual(set(), result)
+        process_info.assert_not_called()
+        self.assertIsNone(tu.job_store.get('youtube-6iRV8liah8A'))
+
+    def test_get_resource_basenames_estimates_the_selected_formats(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    min_free_space=10 ** 9)
+
+        # Like an entry extracted without processing, only the formats
+        # know the size of the download.
+        entry = {
+            'id': 'KdsN9YhkDrY',
+            'title': 'Epic Ramadan',
+            'extractor': 'youtube',
+            'extractor_key': 'Youtube',
+            'webpage_url': 'https://www.youtube.com/watch?v=KdsN9YhkDrY',
+            'formats': [{'format_id': '18', 'ext': 'mp4',
+                         'url': 'https://example.com/18.mp4',
+                         'vcodec': 'avc1', 'acodec': 'mp4a',
+                         'filesize': 2 * 10 ** 9}],
+        }
+
+        with patch.object(MockYTDLP, 'extract_info', return_value=entry), \
+                patch.object(MockYTDLP, 'process_ie_result',
+                             YoutubeDL.process_ie_result), \
+                patch.object(MockYTDLP, 'process_info') as process_info, \
+                patch('tubeup.scheduling.shutil.disk_usage',
+                      return_value=Mock(free=2 * 10 ** 9)):
+            result = tu.get_resource_basenames(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+                ignore_existing_item=True)
+
+        # 2 GB would leave less than 1 GB free
+        self.assertEqual(set(), result)
+        process_info.assert_not_called()
+
+    def test_ia_session_throttles_uploads(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'),
+                    bandwidth_limit=1000)
+
+        adapter = tu.ia_session.get_adapter('https://s3.us.archive.org/item')
+        self.assertIs(tu.bandwidth, adapter.budget)
 
     def test_upload_ia(self):
         tu = TubeUp(dir_path=os.path.join(current_path,
@@ -504,7 +1101,7 @@ class TubeUpTests(unittest.TestCase):
 
         videobasename = os.path.join(
             current_path, 'test_tubeup_rootdir', 'downloads',
-            'Mountain_3_-_Video_Background_HD_1080p-6iRV8liah8A')
+            'youtube-6iRV8liah8A', 'Mountain_3_-_Video_Background_HD_1080p-6iRV8liah8A')
 
         copy_testfiles_to_tubeup_rootdir_test()
 
@@ -553,6 +1150,192 @@ class TubeUpTests(unittest.TestCase):
                  'scanner': SCANNER})
 
             self.assertEqual(expected_result, result)
+            # The uploaded files are deleted along with their job directory
+            self.assertFalse(os.path.exists(os.path.dirname(videobasename)))
+
+    def test_upload_ia_with_incomplete_download(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'))
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        open(videobasename + '.f248.webm.part', 'w').close()
+
+        with self.assertRaisesRegex(Exception, 'download incomplete'):
+            tu.upload_ia(videobasename)
+        self.assertTrue(os.path.exists(videobasename + '.mp4'))
+
+    def record_download_hooks(self, tu, videobasename):
+        info_dict = {'infojson_filename': videobasename + '.info.json',
+                     'filepath': videobasename + '.mp4',
+                     '__files_to_move': {videobasename + '.webp': ''}}
+        tu.record_downloaded_file({'status': 'finished',
+                                   'filename': videobasename + '.mp4',
+                                   'info_dict': info_dict})
+        tu.record_postprocessed_files({'status': 'started',
+                                       'postprocessor': 'MoveFiles',
+                                       'info_dict': info_dict})
+        self.assertFalse(tu.manifests[videobasename].complete)
+        tu.record_postprocessed_files({'status': 'finished',
+                                       'postprocessor': 'MoveFiles',
+                                       'info_dict': info_dict})
+
+    def test_record_download_hooks(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        self.record_download_hooks(tu, videobasename)
+
+        manifest = tu.manifests[videobasename]
+        self.assertTrue(manifest.complete)
+        self.assertEqual({videobasename + ext
+                          for ext in ('.mp4', '.webp', '.info.json',
+                                      '.description')}, manifest.paths)
+
+    def test_upload_ia_with_manifest(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'))
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        self.record_download_hooks(tu, videobasename)
+
+        with requests_mock.Mocker() as m:
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            mock_upload_response_by_videobasename(
+                m, 'youtube-KdsN9YhkDrY', videobasename)
+
+            tu.upload_ia(videobasename)
+
+            uploaded_files = {os.path.basename(request.path)
+                              for request in m.request_history
+                              if request.method == 'PUT'}
+
+        # The webm file was never reported by yt-dlp
+        self.assertEqual({'kdsn9yhkdry' + ext
+                          for ext in ('.mp4', '.webp', '.info.json',
+                                      '.description')}, uploaded_files)
+        self.assertTrue(os.path.exists(videobasename + '.webm'))
+        self.assertNotIn(videobasename, tu.manifests)
+
+    def test_upload_ia_with_incomplete_manifest(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'))
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        tu.record_downloaded_file({
+            'status': 'finished', 'filename': videobasename + '.mp4',
+            'info_dict': {'infojson_filename': videobasename + '.info.json'}})
+
+        with self.assertRaisesRegex(Exception, 'download incomplete'):
+            tu.upload_ia(videobasename)
+
+    def upload_ia_with_large_video(self, multipart_upload):
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        # Larger than the threshold, unlike the info.json
+        with open(videobasename + '.mp4', 'wb') as f:
+            f.write(b'\0' * 40000)
+
+        with patch('tubeup.TubeUp.DEFAULT_PART_SIZE', 1000):
+            tu = TubeUp(dir_path=os.path.join(current_path,
+                                              'test_tubeup_rootdir'),
+                        ia_config_path=get_testfile_path('ia_config_for_test.ini'),
+                        multipart_threshold=35000)
+        tu.job_store.set_state('youtube-KdsN9YhkDrY', 'downloaded',
+                               videobasename)
+
+        with requests_mock.Mocker() as m, \
+                patch('tubeup.TubeUp.MultipartUpload', multipart_upload):
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{"result": "youtube-KdsN9YhkDrY"}',
+                  headers={'content-type': 'application/json'})
+            mock_upload_response_by_videobasename(
+                m, 'youtube-KdsN9YhkDrY', videobasename)
+
+            try:
+                tu.upload_job(videobasename)
+            finally:
+                self.derive_headers = {
+                    request.headers['x-archive-queue-derive']
+                    for request in m.request_history
+                    if request.method == 'PUT'}
+        return tu, videobasename
+
+    def test_upload_ia_with_multipart_threshold(self):
+        multipart_upload = Mock()
+
+        tu, videobasename = self.upload_ia_with_large_video(multipart_upload)
+
+        # The derive is queued with the video uploaded in parts
+        self.assertEqual({'0'}, self.derive_headers)
+        multipart_upload.assert_called_once()
+        args, kwargs = multipart_upload.call_args
+        self.assertEqual(
+            ('https://s3.us.archive.org/youtube-KdsN9YhkDrY/KdsN9YhkDrY.mp4',
+             videobasename + '.mp4'), args[1:])
+        self.assertEqual('1', kwargs['headers']['x-archive-queue-derive'])
+        multipart_upload.return_value.upload.assert_called_once_with()
+        self.assertFalse(os.path.exists(videobasename + '.mp4'))
+        self.assertFalse(os.path.exists(videobasename + '.info.json'))
+
+    def test_interrupted_multipart_upload_keeps_the_job_resumable(self):
+        multipart_upload = Mock()
+        multipart_upload.return_value.upload.side_effect = \
+            requests.exceptions.ConnectionError('Connection reset')
+
+        with self.assertRaises(MultipartUploadInterrupted):
+            self.upload_ia_with_large_video(multipart_upload)
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+        # The files are kept, and the job is resumed from them by the next run
+        self.assertTrue(os.path.exists(videobasename + '.info.json'))
+        self.assertTrue(os.path.exists(videobasename + '.mp4'))
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'))
+        self.assertEqual(('downloaded', videobasename),
+                         tu.job_store.get('youtube-KdsN9YhkDrY'))
+
+    def test_multipart_threshold_must_be_larger_than_a_part(self):
+        with self.assertRaises(ValueError):
+            TubeUp(dir_path=os.path.join(current_path,
+                                         'test_tubeup_rootdir'),
+                   multipart_threshold=0)
 
     def test_archive_urls(self):
         tu = TubeUp(dir_path=os.path.join(current_path,
@@ -561,7 +1344,7 @@ class TubeUpTests(unittest.TestCase):
 
         videobasename = os.path.join(
             current_path, 'test_tubeup_rootdir', 'downloads',
-            'KdsN9YhkDrY')
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
 
         copy_testfiles_to_tubeup_rootdir_test()
 
@@ -576,6 +1359,9 @@ class TubeUpTests(unittest.TestCase):
             m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
                   content=b'{}',
                   headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
 
             # Mock the PUT requests for internetarchive urls that defined
             # in mock_upload_response_by_videobasename(), so this test
@@ -613,3 +1399,471 @@ class TubeUpTests(unittest.TestCase):
                  'scanner': SCANNER})]
 
             self.assertEqual(expected_result, result)
+
+    def test_archive_urls_pipelined(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'),
+                    pipeline_depth=1)
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m:
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            mock_upload_response_by_videobasename(
+                m, 'youtube-KdsN9YhkDrY', videobasename)
+
+            result = list(tu.archive_urls(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY']))
+
+            self.assertEqual(['youtube-KdsN9YhkDrY'],
+                             [identifier for identifier, _ in result])
+            self.assertEqual('Epic Ramadan - Video Background HD1080p',
+                             result[0][1]['title'])
+
+    def test_iter_pipelined_basenames_stops_downloads_when_closed(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    pipeline_depth=1)
+
+        handed_over = []
+        download_stage_done = threading.Event()
+
+        def get_resource_basenames(urls, *args, basename_callback=None,
+                                   **kwargs):
+            try:
+                for index in range(10):
+                    basename_callback('video%d' % index)
+                    handed_over.append(index)
+            finally:
+                download_stage_done.set()
+
+        with patch.object(tu, 'get_resource_basenames',
+                          side_effect=get_resource_basenames):
+            basenames = tu.iter_pipelined_basenames(['url'])
+            self.assertEqual('video0', next(basenames))
+            # Like an upload failing in the consumer
+            basenames.close()
+
+            self.assertTrue(download_stage_done.wait(5))
+        self.assertLess(len(handed_over), 10)
+
+    def test_get_resource_basenames_skips_uploaded_jobs(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        tu.job_store.set_state('youtube-KdsN9YhkDrY', 'uploaded')
+        tu.job_store.set_state('youtube-6iRV8liah8A', 'verified')
+
+        with patch.object(MockYTDLP, 'process_ie_result') as process_ie_result:
+            # No archive.org request is mocked, the jobs are enough
+            result = tu.get_resource_basenames([FLAT_PLAYLIST_URL])
+
+        self.assertEqual(set(), result)
+        process_ie_result.assert_not_called()
+
+    def test_get_resource_basenames_with_failed_download(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        def failed_download(ydl, info_dict):
+            # yt-dlp ignores the error once the info.json has been written
+            os.remove(videobasename + '.mp4')
+            os.remove(videobasename + '.webm')
+            with open(videobasename + '.mp4.part', 'wb') as f:
+                f.write(b'\0')
+
+        with patch.object(MockYTDLP, 'process_info', autospec=True,
+                          side_effect=failed_download):
+            tu.get_resource_basenames(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+                ignore_existing_item=True)
+
+        self.assertEqual(('discovered', None),
+                         tu.job_store.get('youtube-KdsN9YhkDrY'))
+
+    def test_archive_urls_records_job_states(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'))
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m:
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            # Missing before the upload, found afterwards
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  [{'content': b'{}',
+                    'headers': {'content-type': 'application/json'}},
+                   {'content': b'{"result": "youtube-KdsN9YhkDrY"}',
+                    'headers': {'content-type': 'application/json'}}])
+            mock_upload_response_by_videobasename(
+                m, 'youtube-KdsN9YhkDrY', videobasename)
+
+            list(tu.archive_urls(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY']))
+
+        self.assertEqual(('verified', videobasename),
+                         tu.job_store.get('youtube-KdsN9YhkDrY'))
+
+    def test_archive_urls_resumes_downloaded_jobs(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'))
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+        # Left behind by a run that died before uploading
+        tu.job_store.set_state('youtube-KdsN9YhkDrY', 'downloaded',
+                               videobasename)
+
+        with requests_mock.Mocker() as m, \
+                patch.object(MockYTDLP, 'process_ie_result') as process_ie_result:
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            mock_upload_response_by_videobasename(
+                m, 'youtube-KdsN9YhkDrY', videobasename)
+
+            result = list(tu.archive_urls(
+                ['https://www.youtube.com/watch?v=KdsN9YhkDrY']))
+
+        # Uploaded once, without downloading it again
+        self.assertEqual(['youtube-KdsN9YhkDrY'],
+                         [identifier for identifier, _ in result])
+        process_ie_result.assert_not_called()
+        self.assertEqual(('uploaded', videobasename),
+                         tu.job_store.get('youtube-KdsN9YhkDrY'))
+
+    def test_enqueue_urls(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        job_queue = JobQueue(os.path.join(tu.dir_path['root'], 'queue.sqlite3'))
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        count = tu.enqueue_urls(job_queue, [
+            FLAT_PLAYLIST_URL, 'https://www.youtube.com/watch?v=KdsN9YhkDrY'])
+
+        # Every video of the playlist is queued on its own
+        self.assertEqual(2, count)
+        self.assertEqual(
+            [('https://www.youtube.com/watch?v=KdsN9YhkDrY',),
+             ('https://www.youtube.com/watch?v=6iRV8liah8A',)],
+            job_queue.execute('SELECT url FROM queue ORDER BY job_id'))
+        job_queue.close()
+
+    def test_enqueue_urls_of_a_channel(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        job_queue = JobQueue(os.path.join(tu.dir_path['root'], 'queue.sqlite3'))
+
+        count = tu.enqueue_urls(job_queue, [CHANNEL_URL])
+
+        # The videos of every tab are queued, not the tabs
+        self.assertEqual(2, count)
+        self.assertEqual(
+            [('https://www.youtube.com/watch?v=KdsN9YhkDrY',),
+             ('https://www.youtube.com/watch?v=6iRV8liah8A',)],
+            job_queue.execute('SELECT url FROM queue ORDER BY job_id'))
+        job_queue.close()
+
+    def test_run_worker(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        job_queue = JobQueue(os.path.join(tu.dir_path['root'], 'queue.sqlite3'))
+        job_queue.enqueue(['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+                           'https://www.youtube.com/watch?v=6iRV8liah8A'])
+
+        def archive_urls(urls, *args, **kwargs):
+            if urls == ['https://www.youtube.com/watch?v=6iRV8liah8A']:
+                raise Exception('Video unavailable')
+            yield 'youtube-KdsN9YhkDrY', {'title': 'Epic Ramadan'}
+
+        with patch.object(tu, 'archive_urls', side_effect=archive_urls):
+            result = list(tu.run_worker(job_queue, 'worker-1',
+                                        exit_when_empty=True))
+
+        self.assertEqual([('youtube-KdsN9YhkDrY', {'title': 'Epic Ramadan'})],
+                         result)
+        self.assertEqual({'done': 1, 'failed': 1}, job_queue.counts())
+        self.assertEqual(
+            [('Video unavailable',)],
+            job_queue.execute("SELECT error FROM queue WHERE state = 'failed'"))
+        job_queue.close()
+
+    def test_run_worker_stops_when_the_lease_is_lost(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        job_queue = JobQueue(os.path.join(tu.dir_path['root'], 'queue.sqlite3'))
+        job_queue.enqueue(['https://www.youtube.com/watch?v=KdsN9YhkDrY'])
+        other_queue = JobQueue(job_queue.path)
+
+        heartbeat = job_queue.heartbeat
+        heartbeats = []
+
+        def locked_heartbeat(*args):
+            heartbeats.append(args)
+            if len(heartbeats) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return heartbeat(*args)
+
+        def archive_urls(urls, *args, cancel_event=None, **kwargs):
+            # The lease expires while the video is downloaded and another
+            # worker takes the url over.
+            job_queue.execute('UPDATE queue SET lease_expires = 0')
+            self.assertIsNotNone(other_queue.claim('worker-2', 60))
+            self.assertTrue(cancel_event.wait(5))
+            yield from tu.upload_basenames(['KdsN9YhkDrY'],
+                                           cancel_event=cancel_event)
+
+        with patch.object(job_queue, 'heartbeat', side_effect=locked_heartbeat), \
+                patch.object(tu, 'archive_urls', side_effect=archive_urls), \
+                patch.object(tu, 'upload_job') as upload_job:
+            result = list(tu.run_worker(job_queue, 'worker-1', lease_time=0.3,
+                                        exit_when_empty=True))
+
+        self.assertEqual([], result)
+        upload_job.assert_not_called()
+        # The failing heartbeat was tried again
+        self.assertGreaterEqual(len(heartbeats), 2)
+        # The job is left to the other worker
+        self.assertEqual([('leased', 'worker-2')],
+                         job_queue.execute('SELECT state, worker FROM queue'))
+        other_queue.close()
+        job_queue.close()
+
+    def test_run_daemon(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        # Archived by an earlier poll
+        tu.job_store.set_state('youtube-KdsN9YhkDrY', 'verified')
+        tu.job_store.set_state('youtube-6iRV8liah8A', 'verified')
+
+        stop_event = threading.Event()
+        polled_urls = []
+        archive_urls = tu.archive_urls
+
+        def poll(urls, *args, **kwargs):
+            polled_urls.extend(urls)
+            if len(polled_urls) == 3:
+                stop_event.set()
+            return archive_urls(urls, *args, **kwargs)
+
+        with patch.object(tu, 'archive_urls', side_effect=poll), \
+                patch('tubeup.TubeUp.YoutubeDL',
+                      side_effect=MockYTDLP) as ydl_class:
+            result = list(tu.run_daemon(
+                [(FLAT_PLAYLIST_URL, 0)], stop_event=stop_event))
+
+        self.assertEqual([], result)
+        self.assertEqual([FLAT_PLAYLIST_URL] * 3, polled_urls)
+        # The same YoutubeDL is used by every poll
+        self.assertEqual(1, ydl_class.call_count)
+
+    def test_archive_batch_file_resumes_at_checkpoint(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        batch_file = os.path.join(tu.dir_path['root'], 'urls.txt')
+        with open(batch_file, 'w') as f:
+            f.write('https://www.youtube.com/watch?v=KdsN9YhkDrY\n'
+                    'https://www.youtube.com/watch?v=6iRV8liah8A\n'
+                    'https://www.youtube.com/watch?v=Zb9nE_mWVus\n')
+
+        archived_chunks = []
+
+        def archive_urls(urls, *args, **kwargs):
+            archived_chunks.append(urls)
+            if len(archived_chunks) == 2:
+                raise Exception('Interrupted')
+            yield 'youtube-%s' % urls[0][-11:], {}
+
+        with patch('tubeup.TubeUp.BATCH_CHUNK_SIZE', 2), \
+                patch.object(tu, 'archive_urls', side_effect=archive_urls):
+            with self.assertRaisesRegex(Exception, '^Interrupted$'):
+                list(tu.archive_batch_file(batch_file))
+            # Only the chunk that was interrupted is archived again
+            result = list(tu.archive_batch_file(batch_file))
+
+        self.assertEqual([['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+                           'https://www.youtube.com/watch?v=6iRV8liah8A'],
+                          ['https://www.youtube.com/watch?v=Zb9nE_mWVus'],
+                          ['https://www.youtube.com/watch?v=Zb9nE_mWVus']],
+                         archived_chunks)
+        self.assertEqual([('youtube-Zb9nE_mWVus', {})], result)
+
+    def test_archive_batch_file_shares_state_between_chunks(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        batch_file = os.path.join(tu.dir_path['root'], 'urls.txt')
+        with open(batch_file, 'w') as f:
+            f.write('https://www.youtube.com/watch?v=KdsN9YhkDrY\n'
+                    'https://www.youtube.com/watch?v=6iRV8liah8A\n'
+                    # Already found in the first chunk
+                    'https://youtu.be/KdsN9YhkDrY\n')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with patch('tubeup.TubeUp.BATCH_CHUNK_SIZE', 2), \
+                patch('tubeup.TubeUp.YoutubeDL',
+                      side_effect=MockYTDLP) as ydl_class, \
+                patch.object(MockYTDLP, 'extract_info', autospec=True,
+                             side_effect=MockYTDLP.extract_info) as extract_info, \
+                patch.object(tu.job_store, 'jobs_in_state',
+                             return_value=[]) as jobs_in_state, \
+                patch.object(tu, 'upload_basenames',
+                             side_effect=lambda *args: iter(())):
+            list(tu.archive_batch_file(batch_file, ignore_existing_item=True))
+
+        # One YoutubeDL, so the download archive is loaded once
+        self.assertEqual(1, ydl_class.call_count)
+        self.assertEqual(
+            ['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+             'https://www.youtube.com/watch?v=6iRV8liah8A'],
+            [call.args[1] for call in extract_info.call_args_list])
+        jobs_in_state.assert_called_once_with('downloaded')
+
+    def test_archive_batch_file_forgets_old_urls(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'))
+        batch_file = os.path.join(tu.dir_path['root'], 'urls.txt')
+        with open(batch_file, 'w') as f:
+            f.write('https://www.youtube.com/watch?v=KdsN9YhkDrY\n'
+                    'https://www.youtube.com/watch?v=6iRV8liah8A\n'
+                    'https://youtu.be/6iRV8liah8A\n'
+                    # Forgotten since the chunk of the first url, it's only
+                    # skipped by its job, which this run doesn't find
+                    'https://www.youtube.com/watch?v=KdsN9YhkDrY\n')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with patch('tubeup.TubeUp.BATCH_CHUNK_SIZE', 2), \
+                patch('tubeup.TubeUp.BATCH_SEEN_URLS', 1), \
+                patch.object(MockYTDLP, 'extract_info', autospec=True,
+                             side_effect=MockYTDLP.extract_info) as extract_info, \
+                patch.object(tu.job_store, 'get', return_value=None), \
+                patch.object(tu, 'upload_basenames',
+                             side_effect=lambda *args: iter(())):
+            list(tu.archive_batch_file(batch_file, ignore_existing_item=True))
+
+        self.assertEqual(
+            ['https://www.youtube.com/watch?v=KdsN9YhkDrY',
+             'https://www.youtube.com/watch?v=6iRV8liah8A',
+             'https://www.youtube.com/watch?v=KdsN9YhkDrY'],
+            [call.args[1] for call in extract_info.call_args_list])
+
+    def test_upload_basenames_with_upload_workers(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'),
+                    upload_workers=2)
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-6iRV8liah8A', 'Mountain_3_-_Video_Background_HD_1080p-6iRV8liah8A')
+        missing_videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'video_that_was_never_downloaded')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m:
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+
+            m.get('https://archive.org/metadata/youtube-6iRV8liah8A',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+            m.get('https://archive.org/metadata/youtube-6iRV8liah8A/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            mock_upload_response_by_videobasename(
+                m, 'youtube-6iRV8liah8A', videobasename)
+
+            results = []
+            # The failing upload must not prevent the other one from
+            # finishing, the error is only raised at the end.
+            with self.assertRaisesRegex(Exception, r'^1 upload\(s\) failed'):
+                for result in tu.upload_basenames(
+                        [missing_videobasename, videobasename]):
+                    results.append(result)
+
+            self.assertEqual(['youtube-6iRV8liah8A'],
+                             [identifier for identifier, _ in results])
+
+    def test_upload_ia_with_file_upload_workers(self):
+        tu = TubeUp(dir_path=os.path.join(current_path,
+                                          'test_tubeup_rootdir'),
+                    ia_config_path=get_testfile_path('ia_config_for_test.ini'),
+                    file_upload_workers=4)
+
+        videobasename = os.path.join(
+            current_path, 'test_tubeup_rootdir', 'downloads',
+            'youtube-KdsN9YhkDrY', 'KdsN9YhkDrY')
+
+        copy_testfiles_to_tubeup_rootdir_test()
+
+        with requests_mock.Mocker() as m:
+            m.get('https://s3.us.archive.org',
+                  content=b'{"over_limit": 0}',
+                  headers={'content-type': 'application/json'})
+
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            mock_upload_response_by_videobasename(
+                m, 'youtube-KdsN9YhkDrY', videobasename)
+
+            identifier, _ = tu.upload_ia(videobasename)
+
+            puts = [r for r in m.request_history if r.method == 'PUT']
+            uploaded_files = sorted(os.path.basename(r.path) for r in puts)
+
+        self.assertEqual('youtube-KdsN9YhkDrY', identifier)
+        self.assertEqual(['kdsn9yhkdry.description', 'kdsn9yhkdry.info.json',
+                          'kdsn9yhkdry.mp4', 'kdsn9yhkdry.webm',
+                          'kdsn9yhkdry.webp'],
+                         uploaded_files)
+        # Derive is only queued once, with the very last request
+        self.assertEqual(['0', '0', '0', '0', '1'],
+                         [r.headers['x-archive-queue-derive'] for r in puts])
+        self.assertFalse(glob.glob(videobasename + '*'))
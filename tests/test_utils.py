@@ -1,6 +1,15 @@
+import io
 import unittest
 import os
-from tubeup.utils import sanitize_identifier, check_is_file_empty
+import tempfile
+import requests_mock
+from tubeup.utils import (sanitize_identifier, check_identifier_exists,
+                          iter_search_identifiers, check_is_file_empty,
+                          parse_channels_file, iter_batch_file,
+                          match_url_extractor, is_video_entry,
+                          estimate_download_size, scan_job_files,
+                          RecentKeys)
+from yt_dlp import YoutubeDL
 
 
 class UtilsTest(unittest.TestCase):
@@ -48,3 +57,177 @@ class UtilsTest(unittest.TestCase):
                 FileNotFoundError,
                 r"^Path 'file_that_doesnt_exist.txt' doesn't exist$"):
             check_is_file_empty('file_that_doesnt_exist.txt')
+
+    def test_check_identifier_exists_when_item_exists(self):
+        with requests_mock.Mocker() as m:
+            m.get('https://archive.org/metadata/youtube-6iRV8liah8A/metadata/identifier',
+                  content=b'{"result": "youtube-6iRV8liah8A"}',
+                  headers={'content-type': 'application/json'})
+
+            self.assertTrue(check_identifier_exists('youtube-6iRV8liah8A'))
+
+    def test_check_identifier_exists_when_item_doesnt_exist(self):
+        with requests_mock.Mocker() as m:
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{}',
+                  headers={'content-type': 'application/json'})
+
+            self.assertFalse(check_identifier_exists('youtube-KdsN9YhkDrY'))
+
+    def test_check_identifier_exists_with_error_response(self):
+        with requests_mock.Mocker() as m:
+            m.get('https://archive.org/metadata/youtube-KdsN9YhkDrY/metadata/identifier',
+                  content=b'{"error": "unable to read the metadata"}',
+                  headers={'content-type': 'application/json'})
+
+            self.assertFalse(check_identifier_exists('youtube-KdsN9YhkDrY'))
+
+    def test_iter_search_identifiers_follows_the_cursor(self):
+        with requests_mock.Mocker() as m:
+            # Stand-in for the scrape API, two pages chained by a cursor
+            m.post('https://archive.org/services/search/v1/scrape',
+                   [{'json': {'items': [{'identifier': 'youtube-6iRV8liah8A'},
+                                        {'identifier': 'youtube-KdsN9YhkDrY'}],
+                              'count': 2, 'total': 3, 'cursor': 'page-2'}},
+                    {'json': {'items': [{'identifier': 'youtube--QBwhSklJks'}],
+                              'count': 1, 'total': 3}}])
+
+            identifiers = list(iter_search_identifiers('channel:"test"'))
+
+            self.assertEqual(['youtube-6iRV8liah8A', 'youtube-KdsN9YhkDrY',
+                              'youtube--QBwhSklJks'], identifiers)
+            self.assertEqual(2, m.call_count)
+            self.assertNotIn('cursor', m.request_history[0].qs)
+            self.assertEqual(['page-2'], m.request_history[1].qs['cursor'])
+
+    def test_parse_channels_file(self):
+        with open('testchannels.txt', 'w') as channels_file:
+            channels_file.write(
+                '# Polled every hour\n'
+                'https://www.youtube.com/@RelaxingWorld\n'
+                '\n'
+                'https://www.youtube.com/@MusicForRelaxation 600\n')
+
+        channels = parse_channels_file('testchannels.txt', 3600)
+        os.remove('testchannels.txt')
+
+        self.assertEqual(
+            [('https://www.youtube.com/@RelaxingWorld', 3600),
+             ('https://www.youtube.com/@MusicForRelaxation', 600)],
+            channels)
+
+    def test_parse_channels_file_with_invalid_interval(self):
+        with open('testchannels.txt', 'w') as channels_file:
+            channels_file.write('https://www.youtube.com/@RelaxingWorld 1h\n')
+
+        with self.assertRaisesRegex(ValueError, r'^testchannels.txt:1: '):
+            parse_channels_file('testchannels.txt', 3600)
+        os.remove('testchannels.txt')
+
+    def test_iter_batch_file(self):
+        batch_file = io.BytesIO(
+            b'# Comment\n'
+            b'https://www.youtube.com/watch?v=KdsN9YhkDrY\n'
+            b'\n'
+            b'https://www.youtube.com/watch?v=6iRV8liah8A')
+
+        self.assertEqual(
+            [('https://www.youtube.com/watch?v=KdsN9YhkDrY', 54),
+             ('https://www.youtube.com/watch?v=6iRV8liah8A', 98)],
+            list(iter_batch_file(batch_file)))
+
+    def test_iter_batch_file_from_offset(self):
+        batch_file = io.BytesIO(b'https://www.youtube.com/watch?v=6iRV8liah8A\n')
+
+        self.assertEqual(
+            [('https://www.youtube.com/watch?v=6iRV8liah8A', 100)],
+            list(iter_batch_file(batch_file, 56)))
+
+    def test_match_url_extractor(self):
+        for url in ('https://youtu.be/KdsN9YhkDrY',
+                    'https://www.youtube.com/watch?v=KdsN9YhkDrY&t=10'):
+            ie, url_id = match_url_extractor(url)
+            self.assertEqual(('Youtube', 'KdsN9YhkDrY'), (ie.ie_key(), url_id))
+
+    def test_match_url_extractor_without_id(self):
+        ie, url_id = match_url_extractor('https://example.com/video.html')
+
+        self.assertEqual('Generic', ie.ie_key())
+        self.assertIsNone(url_id)
+
+    def test_is_video_entry(self):
+        with YoutubeDL({'quiet': True}) as ydl:
+            self.assertTrue(is_video_entry(ydl, {
+                '_type': 'url', 'ie_key': 'Youtube',
+                'url': 'https://www.youtube.com/watch?v=KdsN9YhkDrY'}))
+            self.assertFalse(is_video_entry(ydl, {
+                '_type': 'url', 'ie_key': 'YoutubeTab',
+                'url': 'https://www.youtube.com/@testchannel/videos'}))
+            self.assertFalse(is_video_entry(ydl, {'_type': 'playlist'}))
+            self.assertTrue(is_video_entry(ydl, {'id': 'KdsN9YhkDrY'}))
+
+    def test_recent_keys(self):
+        keys = RecentKeys(2)
+        keys.add('a')
+        keys.add('b')
+        # Found again, so 'b' is now the oldest key
+        self.assertIn('a', keys)
+        keys.add('c')
+
+        self.assertEqual(2, len(keys))
+        self.assertIn('a', keys)
+        self.assertIn('c', keys)
+        self.assertNotIn('b', keys)
+
+    def test_estimate_download_size(self):
+        self.assertEqual(300, estimate_download_size({
+            'filesize': 5,
+            'requested_formats': [{'filesize': 100},
+                                  {'filesize_approx': 200}]}))
+        self.assertEqual(50, estimate_download_size({'filesize_approx': 50}))
+        self.assertEqual(0, estimate_download_size({'id': 'abc'}))
+
+    def test_scan_job_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for filename in ('abc.mp4', 'abc.info.json', 'abc.en.vtt',
+                             'abc.webp', 'abc.description', 'abcd.mp4',
+                             'abc', 'abc.f137.mp4', 'abc.f140.m4a.part',
+                             'abc.f401.mp4'):
+                open(os.path.join(tmpdir, filename), 'w').close()
+            os.mkdir(os.path.join(tmpdir, 'abc.d'))
+
+            job_files = scan_job_files(os.path.join(tmpdir, 'abc'),
+                                       {'format_id': '137+140'})
+
+            self.assertEqual(['abc.f401.mp4', 'abc.mp4'],
+                             sorted(entry.name for entry in job_files.media))
+            self.assertEqual(['abc.description', 'abc.en.vtt',
+                              'abc.info.json', 'abc.webp'],
+                             sorted(entry.name
+                                    for entry in job_files.sidecars))
+            self.assertEqual(['abc.f137.mp4', 'abc.f140.m4a.part'],
+                             sorted(entry.name for entry in job_files.stubs))
+
+    def test_scan_job_files_in_progress(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for filename in ('abc.mp4.part', 'abc.mp4.ytdl',
+                             'abc.mp4.part-Frag12', 'abc.temp.mp4'):
+                open(os.path.join(tmpdir, filename), 'w').close()
+
+            job_files = scan_job_files(os.path.join(tmpdir, 'abc'))
+
+            self.assertEqual(([], []), (job_files.media, job_files.sidecars))
+            self.assertEqual(4, len(job_files.stubs))
+
+    def test_check_is_file_empty_with_dir_entry(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'abc.description'), 'w') as f:
+                f.write('description')
+            open(os.path.join(tmpdir, 'abc.annotations.xml'), 'w').close()
+
+            with os.scandir(tmpdir) as entries:
+                emptiness = {entry.name: check_is_file_empty(entry)
+                             for entry in entries}
+
+            self.assertEqual({'abc.description': False,
+                              'abc.annotations.xml': True}, emptiness)
@@ -1,24 +1,102 @@
 import os
 import sys
 import re
-import glob
 import time
 import json
+import heapq
+import queue
 import logging
+import itertools
+import contextlib
+import collections
+import threading
+import sqlite3
+import requests
 import internetarchive
 
+from concurrent.futures import (ThreadPoolExecutor, Future, wait,
+                                ALL_COMPLETED, FIRST_COMPLETED)
+from internetarchive.auth import S3Auth
 from internetarchive.config import parse_config_file
-from datetime import datetime
+from datetime import datetime, timezone
 from yt_dlp import YoutubeDL
-from .utils import (get_itemname, check_is_file_empty,
+from .utils import (get_itemname, check_identifier_exists,
+                    iter_search_identifiers, iter_batch_file,
+                    match_url_extractor, is_video_entry,
+                    estimate_download_size,
+                    scan_job_files, JobManifest, RecentKeys,
+                    check_is_file_empty,
                     EMPTY_ANNOTATION_FILE)
+from .state import (ItemExistenceCache, DownloadArchive, JobStore, SyncMarks,
+                    BatchCheckpoints, MultipartUploads)
+from .scheduling import (ExtractorScheduler, BandwidthBudget,
+                         ThrottledUploadAdapter, DiskSpaceGate)
+from .multipart import DEFAULT_PART_SIZE, MultipartUpload
 from logging import getLogger
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 
 from tubeup import __version__
 
 
 DOWNLOAD_DIR_NAME = 'downloads'
+# Every video is downloaded into its own directory of the downloads
+# directory, so its files can be listed without scanning the others.
+JOB_DIR_TEMPLATE = '%(extractor)s-%(id)s'
+ITEM_CACHE_FILE_NAME = '.iacache.sqlite3'
+DOWNLOAD_ARCHIVE_FILE_NAME = '.ytdlarchive'
+DOWNLOAD_ARCHIVE_BACKENDS = ('text', 'sqlite')
+JOB_STORE_FILE_NAME = '.jobs.sqlite3'
+SYNC_MARKS_FILE_NAME = '.syncmarks.sqlite3'
+BATCH_CHECKPOINTS_FILE_NAME = '.batches.sqlite3'
+MULTIPART_UPLOADS_FILE_NAME = '.multipart.sqlite3'
+
+# Host of the archive.org S3 API, which `internetarchive` doesn't expose.
+S3_HOST = 's3.us.archive.org'
+
+# Put on the pipeline queue once the download stage has nothing left to hand
+# over to the upload stage.
+_PIPELINE_DONE = object()
+
+# Number of upcoming playlist entries checked against archive.org ahead of
+# the downloads, per pre-flight worker.
+PREFLIGHT_LOOKAHEAD = 4
+
+# Number of urls added to a job queue per transaction, so workers can claim
+# urls while a large channel is being queued.
+ENQUEUE_BATCH_SIZE = 500
+
+# Number of urls of a batch file archived between two checkpoints.
+BATCH_CHUNK_SIZE = 100
+
+# Number of url keys of a batch file remembered to skip the duplicates found
+# in later chunks, about 30 MB of them.
+BATCH_SEEN_URLS = 100000
+
+
+class ArchivingCancelled(Exception):
+    """
+    Raised by `archive_urls` when its `cancel_event` is set, before the
+    next download or upload.
+    """
+
+
+class MultipartUploadInterrupted(Exception):
+    """
+    Raised by `upload_ia` when the upload in parts of a large file fails.
+    The files of the video are kept, so the next run can resume it.
+    """
+
+
+def _raise_if_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise ArchivingCancelled('The archiving has been cancelled')
+
+
+class _PipelineStopped(Exception):
+    """
+    Raised in the download stage of a pipeline once the upload stage has
+    stopped consuming its basenames.
+    """
 
 
 class TubeUp(object):
@@ -27,24 +105,135 @@ class TubeUp(object):
                  verbose=False,
                  dir_path='~/.tubeup',
                  ia_config_path=None,
-                 output_template=None):
+                 output_template=None,
+                 pipeline_depth=0,
+                 download_workers=1,
+                 upload_workers=1,
+                 file_upload_workers=1,
+                 preflight_workers=4,
+                 missing_item_ttl=86400,
+                 bulk_prefetch=False,
+                 download_archive_backend='text',
+                 incremental_sync=False,
+                 extractor_limits=None,
+                 bandwidth_limit=None,
+                 download_share=None,
+                 min_free_space=None,
+                 multipart_threshold=None,
+                 multipart_workers=4):
         """
         `tubeup` is a tool to archive YouTube by downloading the videos and
         uploading it back to the archive.org.
 
-        :param verbose:         A boolean, True means all loggings will be
-                                printed out to stdout.
-        :param dir_path:        A path to directory that will be used for
-                                saving the downloaded resources. Default to
-                               '~/.tubeup'.
-        :param ia_config_path:  Path to an internetarchive config file, will
-                                be used in uploading the file.
-        :param output_template: A template string that will be used to
-                                generate the output filenames.
+        :param verbose:              A boolean, True means all loggings will be
+                                     printed out to stdout.
+        :param dir_path:             A path to directory that will be used for
+                                     saving the downloaded resources. Default to
+                                    '~/.tubeup'.
+        :param ia_config_path:       Path to an internetarchive config file, will
+                                     be used in uploading the file.
+        :param output_template:      A template string that will be used to
+                                     generate the output filenames.
+        :param pipeline_depth:       Upload each video as soon as its download
+                                     has finished instead of after all the urls
+                                     have been downloaded. The value is the
+                                     number of finished downloads that may wait
+                                     for the upload stage, 0 disables pipelining.
+        :param download_workers:     Number of videos that will be downloaded at
+                                     the same time, every worker uses its own
+                                     YoutubeDL instance.
+        :param upload_workers:       Number of items that will be uploaded to
+                                     archive.org at the same time.
+        :param file_upload_workers:  Number of files of a single item that
+                                     will be uploaded at the same time.
+        :param preflight_workers:    Number of upcoming playlist entries that
+                                     will be checked against archive.org at
+                                     the same time while the current ones are
+                                     downloaded, 0 disables pre-flight checks.
+        :param missing_item_ttl:     Number of seconds an item that was found
+                                     missing from archive.org is remembered as
+                                     missing, items that exist are remembered
+                                     for good.
+        :param bulk_prefetch:        Fetch all the items of a channel that
+                                     exist on archive.org with one search
+                                     query before checking its videos.
+        :param download_archive_backend: How the download archive is stored,
+                                     either 'text' for the yt-dlp text file or
+                                     'sqlite' for an indexed database that
+                                     imports the text file.
+        :param incremental_sync:     Stop walking a playlist at the entry
+                                     marked by an earlier run, the newest one
+                                     from which on all the entries have been
+                                     archived. Only for playlists listing
+                                     their newest videos first, like channels.
+        :param extractor_limits:     A dict of extractor keys to tuples of the
+                                     number of extractions and downloads of
+                                     the extractor that may run at the same
+                                     time and of how many of them may start
+                                     per second, see `ExtractorScheduler`.
+        :param bandwidth_limit:      Number of bytes per second shared by all
+                                     the downloads and uploads, None means no
+                                     limit. It can be changed later with
+                                     `bandwidth.configure`.
+        :param download_share:       Part of the bandwidth limit, between 0
+                                     and 1 excluded, given to the downloads,
+                                     the uploads get the rest. None shares
+                                     the limit evenly between all the
+                                     running downloads and uploads.
+        :param min_free_space:       Number of bytes that must stay free on
+                                     the disk of the downloads directory, a
+                                     download is only started while its
+                                     estimated size fits above it. None
+                                     means no limit.
+        :param multipart_threshold:  Files of at least this number of bytes
+                                     are uploaded in parts sent at the same
+                                     time, a failing part being retried on
+                                     its own. It must be larger than the
+                                     part size. None uploads every file in
+                                     a single request.
+        :param multipart_workers:    Number of parts of a file that will be
+                                     uploaded at the same time.
         """
         self.dir_path = dir_path
         self.verbose = verbose
         self.ia_config_path = ia_config_path
+        self._ia_session = None
+        self.pipeline_depth = pipeline_depth
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.file_upload_workers = file_upload_workers
+        self.preflight_workers = preflight_workers
+        self.missing_item_ttl = missing_item_ttl
+        self.bulk_prefetch = bulk_prefetch
+        if download_archive_backend not in DOWNLOAD_ARCHIVE_BACKENDS:
+            raise ValueError('Unknown download archive backend %r, expected '
+                             'one of %s' % (download_archive_backend,
+                                            ', '.join(DOWNLOAD_ARCHIVE_BACKENDS)))
+        self.download_archive_backend = download_archive_backend
+        self.incremental_sync = incremental_sync
+        self.scheduler = ExtractorScheduler(extractor_limits)
+        self.bandwidth = BandwidthBudget(bandwidth_limit, download_share)
+        self.disk_space = DiskSpaceGate(min_free_space)
+        if (multipart_threshold is not None and
+                multipart_threshold <= DEFAULT_PART_SIZE):
+            raise ValueError('The multipart threshold must be larger than '
+                             'the part size of %d bytes' % DEFAULT_PART_SIZE)
+        self.multipart_threshold = multipart_threshold
+        self.multipart_workers = multipart_workers
+        # Identifiers known to exist from search queries, and the queries
+        # that have already been run.
+        self.existing_items = set()
+        self._prefetched_queries = set()
+        # Lists of the idle YoutubeDL instances kept across calls by the
+        # daemon and the batch files, None when every call uses its own
+        # instances.
+        self._warm_ydls = None
+        # Keys of the urls handled last by the earlier chunks of a batch
+        # file, None when every call only skips its own duplicate urls.
+        self._seen_urls = None
+        # The files written by yt-dlp for every basename, see
+        # `record_downloaded_file`.
+        self.manifests = {}
         self.logger = getLogger(__name__)
         if output_template is None:
             self.output_template = '%(id)s.%(ext)s'
@@ -81,15 +270,192 @@ class TubeUp(object):
             'downloads': os.path.join(extended_usr_dir_path,
                                       DOWNLOAD_DIR_NAME)
         }
+        self._item_cache = None
+        self._download_archive = None
+        self._job_store = None
+        self._sync_marks = None
+        self._batch_checkpoints = None
+        self._multipart_uploads = None
+
+    @property
+    def ia_session(self):
+        """
+        An `internetarchive.ArchiveSession` configured with `ia_config_path`,
+        created on first use. Its uploads draw from the bandwidth budget.
+        """
+        if self._ia_session is None:
+            session = internetarchive.get_session(
+                config_file=self.ia_config_path)
+            session.mount('%s//%s' % (session.protocol, S3_HOST),
+                          ThrottledUploadAdapter(self.bandwidth,
+                                                 **session.http_adapter_kwargs))
+            self._ia_session = session
+        return self._ia_session
+
+    @property
+    def item_cache(self):
+        """
+        The `ItemExistenceCache` kept in the root directory, opened on first
+        use.
+        """
+        if self._item_cache is None:
+            self._item_cache = ItemExistenceCache(
+                os.path.join(self.dir_path['root'], ITEM_CACHE_FILE_NAME),
+                missing_ttl=self.missing_item_ttl)
+        return self._item_cache
+
+    @property
+    def download_archive(self):
+        """
+        The download archive given to YoutubeDL, the path of the text file
+        or, with the sqlite backend, a `DownloadArchive` that has imported
+        the text file.
+        """
+        text_archive_path = os.path.join(self.dir_path['root'],
+                                         DOWNLOAD_ARCHIVE_FILE_NAME)
+        if self.download_archive_backend == 'text':
+            return text_archive_path
+
+        if self._download_archive is None:
+            self._download_archive = DownloadArchive(
+                text_archive_path + '.sqlite3')
+            self._download_archive.import_file(text_archive_path)
+        return self._download_archive
+
+    @property
+    def job_store(self):
+        """
+        The `JobStore` kept in the root directory, opened on first use.
+        """
+        if self._job_store is None:
+            self._job_store = JobStore(
+                os.path.join(self.dir_path['root'], JOB_STORE_FILE_NAME))
+        return self._job_store
+
+    @property
+    def sync_marks(self):
+        """
+        The `SyncMarks` kept in the root directory, opened on first use.
+        """
+        if self._sync_marks is None:
+            self._sync_marks = SyncMarks(
+                os.path.join(self.dir_path['root'], SYNC_MARKS_FILE_NAME))
+        return self._sync_marks
+
+    @property
+    def batch_checkpoints(self):
+        """
+        The `BatchCheckpoints` kept in the root directory, opened on first
+        use.
+        """
+        if self._batch_checkpoints is None:
+            self._batch_checkpoints = BatchCheckpoints(
+                os.path.join(self.dir_path['root'],
+                             BATCH_CHECKPOINTS_FILE_NAME))
+        return self._batch_checkpoints
+
+    @property
+    def multipart_uploads(self):
+        """
+        The `MultipartUploads` kept in the root directory, opened on first
+        use.
+        """
+        if self._multipart_uploads is None:
+            self._multipart_uploads = MultipartUploads(
+                os.path.join(self.dir_path['root'],
+                             MULTIPART_UPLOADS_FILE_NAME))
+        return self._multipart_uploads
+
+    @contextlib.contextmanager
+    def open_ydl(self, ydl_opts, key):
+        """
+        Open a YoutubeDL, the daemon and the batch files reuse an instance
+        opened with the same key by an earlier call so its extractors,
+        cookies, connections and download archive stay loaded.
+
+        :param ydl_opts:  Options of the YoutubeDL.
+        :param key:       A hashable made of the arguments `ydl_opts` has
+                          been generated from.
+        """
+        if self._warm_ydls is None:
+            with YoutubeDL(ydl_opts) as ydl:
+                yield ydl
+            return
+
+        idle_ydls = self._warm_ydls.setdefault(key, [])
+        ydl = idle_ydls.pop() if idle_ydls else YoutubeDL(ydl_opts)
+        try:
+            yield ydl
+        finally:
+            idle_ydls.append(ydl)
+
+    @contextlib.contextmanager
+    def warm_ydls(self):
+        """
+        Keep the YoutubeDL instances opened with `open_ydl` until the end of
+        the block, they are closed afterwards.
+        """
+        if self._warm_ydls is not None:
+            yield
+            return
+
+        self._warm_ydls = {}
+        try:
+            yield
+        finally:
+            for idle_ydls in self._warm_ydls.values():
+                for ydl in idle_ydls:
+                    ydl.close()
+            self._warm_ydls = None
+
+    @contextlib.contextmanager
+    def download_transfer(self, ydl):
+        """
+        Draw from the bandwidth budget while a YoutubeDL downloads, its rate
+        limit follows the rate the download gets from the budget.
+
+        Only plain HTTP downloads follow a change of the rate while they
+        run. A fragmented download, e.g. HLS or DASH, keeps the rate it had
+        when it started, as does an external downloader.
+
+        :param ydl:  The YoutubeDL doing the download.
+        """
+        ratelimit = ydl.params.get('ratelimit')
+
+        def set_ratelimit(rate):
+            # The HTTP downloader reads the rate limit from the params of
+            # the YoutubeDL for every chunk. The fragment downloader copies
+            # them when it starts, the change only reaches later downloads.
+            if rate and ratelimit:
+                rate = min(rate, ratelimit)
+            ydl.params['ratelimit'] = rate or ratelimit
+
+        try:
+            with self.bandwidth.transfer('download', on_rate=set_ratelimit):
+                yield
+        finally:
+            ydl.params['ratelimit'] = ratelimit
 
     def get_resource_basenames(self, urls,
                                cookie_file=None, proxy_url=None,
                                ydl_username=None, ydl_password=None,
                                use_download_archive=False,
-                               ignore_existing_item=False):
+                               ignore_existing_item=False,
+                               basename_callback=None,
+                               flat_playlist=False,
+                               cancel_event=None):
         """
         Get resource basenames from an url.
 
+        Playlists are walked lazily, every entry is extracted right before it
+        gets downloaded and nothing but its basenames is kept afterwards, so
+        the memory use doesn't grow with the size of the playlist.
+
+        Videos whose job has already been downloaded or uploaded by a
+        previous run are neither extracted nor downloaded again. The urls
+        are matched with their extractor first, so a video given in several
+        forms, or found in several playlists, is only extracted once.
+
         :param urls:                  A list of urls that will be downloaded with
                                       youtubedl.
         :param cookie_file:           A cookie file for YoutubeDL.
@@ -103,32 +469,339 @@ class TubeUp(object):
                                       the archive file. Record the IDs of all
                                       downloaded videos in it.
         :param ignore_existing_item:  Ignores the check for existing items on archive.org.
+        :param basename_callback:     A function that will be called with every new
+                                      basename as soon as its download has finished.
+        :param flat_playlist:         Check playlist entries against archive.org
+                                      before extracting them, only the entries that
+                                      don't exist on archive.org yet get extracted.
+        :param cancel_event:          A `threading.Event`, once it's set no more
+                                      video is extracted or downloaded and
+                                      `ArchivingCancelled` is raised.
         :return:                      Set of videos basename that has been downloaded.
         """
         downloaded_files_basename = set()
+        basenames_lock = threading.Lock()
+
+        # Items that have been handled by this call, and the number of
+        # extractions that duplicates didn't cost.
+        handled_items = set()
+        saved_extractions = 0
+
+        def handle_item_once(itemname):
+            with basenames_lock:
+                if itemname in handled_items:
+                    return False
+                handled_items.add(itemname)
+                return True
+
+        def skip_duplicate():
+            nonlocal saved_extractions
+            with basenames_lock:
+                saved_extractions += 1
+
+        def iter_unique_urls(urls):
+            # The same video often comes as a short url, with a timestamp or
+            # other query parameters, the extractor and the id tell them
+            # apart without any request. The id of a playlist or a tab is
+            # often the one of its channel, e.g. for the videos and the
+            # shorts of a channel, so only their exact url is matched.
+            seen_urls = self._seen_urls if self._seen_urls is not None else set()
+            for url in urls:
+                ie, url_id = match_url_extractor(url)
+                if (url_id is not None and
+                        getattr(ie, '_RETURN_TYPE', None) == 'video'):
+                    key = (ie.ie_key(), url_id)
+                else:
+                    key = url
+                if key in seen_urls:
+                    self.logger.debug('Skipping duplicate url %s' % url)
+                    skip_duplicate()
+                    continue
+                seen_urls.add(key)
+                yield url, ie, url_id
+
+        def record_basenames(basenames):
+            with basenames_lock:
+                for basename in basenames - downloaded_files_basename:
+                    downloaded_files_basename.add(basename)
+                    if basename_callback is not None:
+                        basename_callback(basename)
+
+        # Answers for the whole run, either a boolean or the future of a
+        # pre-flight check that is still running. Flat entries get checked
+        # again once they have been extracted.
+        known_items = {}
+        preflight_executor = None
+        if not ignore_existing_item and self.preflight_workers > 0:
+            preflight_executor = ThreadPoolExecutor(
+                max_workers=self.preflight_workers)
 
         def check_if_ia_item_exists(infodict):
             itemname = get_itemname(infodict)
-            item = internetarchive.get_item(itemname)
-            if item.exists and self.verbose:
-                print("\n:: Item already exists. Not downloading.")
-                print('Title: %s' % infodict['title'])
-                print('Video URL: %s\n' % infodict['webpage_url'])
+            exists = known_items.get(itemname)
+            if exists is None:
+                exists = self.ia_item_exists(itemname)
+            elif isinstance(exists, Future):
+                exists = exists.result()
+            known_items[itemname] = exists
+            if exists:
+                if self.verbose:
+                    print("\n:: Item already exists. Not downloading.")
+                    print('Title: %s' % infodict.get('title'))
+                    print('Video URL: %s\n' % infodict.get('webpage_url',
+                                                           infodict.get('url')))
+                return True
+            return False
+
+        def has_resumable_job(itemname):
+            job = self.job_store.get(itemname)
+            return job is not None and job[0] in ('downloaded', 'uploaded',
+                                                  'verified')
+
+        def resume_job(itemname):
+            # The jobs a previous run has taken past the download don't need
+            # any network request.
+            job = self.job_store.get(itemname)
+            if job is None:
+                return False
+            state, basename = job
+            if state in ('uploaded', 'verified'):
+                return True
+            if (state == 'downloaded' and
+                    os.path.exists(basename + '.info.json')):
+                record_basenames({basename})
                 return True
             return False
 
-        def ydl_progress_each(entry):
+        def ydl_progress_each(ydl, entry):
             if not entry:
                 self.logger.warning('Video "%s" is not available. Skipping.' % url)
                 return
             if ydl.in_download_archive(entry):
                 return
-            if not check_if_ia_item_exists(entry):
-                ydl.extract_info(entry['webpage_url'])
-                downloaded_files_basename.update(self.create_basenames_from_ydl_info_dict(ydl, entry))
+            itemname = get_itemname(entry)
+            if not handle_item_once(itemname):
+                return
+            if resume_job(itemname):
+                ydl.record_download_archive(entry)
+            elif ignore_existing_item or not check_if_ia_item_exists(entry):
+                # Select the formats first, the size of the download is only
+                # known from them. The info dict has already been extracted,
+                # so the webpage isn't extracted all over again.
+                info_dict = ydl.process_ie_result(entry, download=False) or entry
+                with self.disk_space.reserve(
+                        self.dir_path['downloads'],
+                        estimate_download_size(info_dict)) as admitted:
+                    if not admitted:
+                        # Not recorded anywhere, so a later run downloads it
+                        msg = ('Not enough disk space to download "%s". '
+                               'Skipping.' % itemname)
+                        self.logger.warning(msg)
+                        if self.verbose:
+                            print(msg)
+                        return
+                    _raise_if_cancelled(cancel_event)
+                    self.job_store.set_state(itemname, 'discovered')
+                    with self.scheduler.slot(entry.get('extractor_key')), \
+                            self.download_transfer(ydl):
+                        ydl.process_info(info_dict)
+                # Like yt-dlp when it downloads the formats it has selected,
+                # process_info only marks a finished download for the archive
+                if info_dict.get('__write_download_archive') is True:
+                    ydl.record_download_archive(info_dict)
+                basenames = self.create_basenames_from_ydl_info_dict(ydl, info_dict)
+                for basename in basenames:
+                    # yt-dlp writes the info.json before the media and
+                    # ignores download errors, a job whose download failed
+                    # stays discovered.
+                    if self.is_download_complete(basename, info_dict):
+                        self.job_store.set_state(itemname, 'downloaded',
+                                                 basename)
+                record_basenames(basenames)
             else:
                 ydl.record_download_archive(entry)
 
+        def iter_playlist_entries(playlist):
+            # Take the entries away from the playlist so the entries that have
+            # been handled can be freed.
+            entries = playlist.pop('entries', None) or []
+            if isinstance(entries, list):
+                entries.reverse()
+                while entries:
+                    yield entries.pop()
+            else:
+                yield from entries
+
+        def playlist_extra_info(playlist, index):
+            # The fields yt-dlp gives to the entries of the playlists it
+            # processes itself
+            return {
+                'playlist': playlist.get('title') or playlist.get('id'),
+                'playlist_id': playlist.get('id'),
+                'playlist_title': playlist.get('title'),
+                'playlist_index': index,
+                'extractor': playlist.get('extractor'),
+                'extractor_key': playlist.get('extractor_key'),
+            }
+
+        def unresolved_info(ydl, entry):
+            # Only the extractor key and the id are known before extraction
+            return dict(
+                entry, extractor=ydl.get_info_extractor(entry['ie_key']).IE_NAME)
+
+        def entry_itemname(ydl, entry, extra_info):
+            if not entry or not entry.get('id'):
+                return None
+            entry_type = entry.get('_type', 'video')
+            if entry_type in ('url', 'url_transparent') and entry.get('ie_key'):
+                return get_itemname(unresolved_info(ydl, entry))
+            if entry_type == 'video':
+                return get_itemname(dict(extra_info, **entry))
+            return None
+
+        def iter_preflighted(ydl, entries):
+            # Check the upcoming entries against archive.org in the
+            # background while the current ones are being downloaded.
+            lookahead = collections.deque()
+            for entry, extra_info in entries:
+                itemname = entry_itemname(ydl, entry, extra_info)
+                if (itemname is not None and itemname not in known_items and
+                        not has_resumable_job(itemname)):
+                    known_items[itemname] = preflight_executor.submit(
+                        self.ia_item_exists, itemname)
+                lookahead.append((entry, extra_info))
+                if len(lookahead) > PREFLIGHT_LOOKAHEAD * self.preflight_workers:
+                    yield lookahead.popleft()
+            while lookahead:
+                yield lookahead.popleft()
+
+        def entry_date(entry):
+            if entry.get('upload_date'):
+                return entry['upload_date']
+            if entry.get('timestamp'):
+                return datetime.fromtimestamp(
+                    entry['timestamp'], timezone.utc).strftime('%Y%m%d')
+            return None
+
+        # The entries every incremental sync has walked, newest first
+        sync_walks = []
+
+        def until_sync_mark(ydl, playlist, entries):
+            # Playlists listing their newest videos first only have new
+            # videos before the entry marked by the previous sync. The tabs
+            # of a channel share the id of the channel, their url tells
+            # them apart.
+            sync_key = '%s:%s' % (playlist.get('extractor_key'),
+                                  playlist.get('webpage_url') or
+                                  playlist.get('id'))
+            mark = self.sync_marks.get(sync_key)
+            walked = []
+            for entry, extra_info in entries:
+                if entry and entry.get('id') and is_video_entry(ydl, entry):
+                    date = entry_date(entry)
+                    if mark is not None and (
+                            entry['id'] == mark[0] or
+                            (date and mark[1] and date < mark[1])):
+                        self.logger.debug('Reached the sync mark of %s at %s'
+                                          % (sync_key, entry['id']))
+                        break
+                    walked.append((
+                        {'id': entry['id'], 'ie_key': entry.get('ie_key'),
+                         'extractor_key': entry.get('extractor_key')},
+                        entry_itemname(ydl, entry, extra_info), date))
+                yield entry, extra_info
+            sync_walks.append((sync_key, walked))
+
+        def is_known_to_exist(itemname):
+            # Only what is already known locally, without any request
+            return (itemname in self.existing_items or
+                    self.item_cache.get(itemname) is True)
+
+        def is_archived(ydl, archive_entry, itemname):
+            return (is_known_to_exist(itemname) or
+                    ydl.in_download_archive(archive_entry))
+
+        def move_sync_marks(ydl):
+            # The new mark is the newest entry of the run of archived entries
+            # the walk ended with, the entries before it are walked again by
+            # the next sync until they have been archived as well.
+            for sync_key, walked in sync_walks:
+                new_mark = None
+                for archive_entry, itemname, date in reversed(walked):
+                    if not is_archived(ydl, archive_entry, itemname):
+                        break
+                    new_mark = (archive_entry['id'], date)
+                if new_mark is not None:
+                    self.sync_marks.set(sync_key, *new_mark)
+
+        def walk_playlist(ydl, playlist):
+            # Only enumerate the playlist, its entries are extracted one at
+            # a time right before they get downloaded.
+            channel_query = self.build_channel_query(playlist)
+            if (self.bulk_prefetch and not ignore_existing_item and
+                    channel_query is not None):
+                self.prefetch_existing_items(channel_query)
+
+            entries = ((entry, playlist_extra_info(playlist, index))
+                       for index, entry in enumerate(
+                           iter_playlist_entries(playlist), 1))
+            if self.incremental_sync:
+                entries = until_sync_mark(ydl, playlist, entries)
+            if preflight_executor is not None:
+                entries = iter_preflighted(ydl, entries)
+            return entries
+
+        def ydl_progress_lazy(ydl, entry, extra_info=None):
+            _raise_if_cancelled(cancel_event)
+            if not entry:
+                self.logger.warning('Video "%s" is not available. Skipping.' % url)
+                return
+
+            entry_type = entry.get('_type', 'video')
+            if entry_type == 'playlist':
+                # e.g. the tabs of a channel
+                for playlist_entry, playlist_info in walk_playlist(ydl, entry):
+                    ydl_progress_lazy(ydl, playlist_entry, playlist_info)
+                return
+            if entry_type not in ('url', 'url_transparent'):
+                for key, value in (extra_info or {}).items():
+                    entry.setdefault(key, value)
+                ydl_progress_each(ydl, entry)
+                return
+
+            # An entry that hasn't been extracted yet, only the extractor key
+            # and the id are known here.
+            if ydl.in_download_archive(entry):
+                return
+            if entry.get('id') and entry.get('ie_key'):
+                unresolved_entry = unresolved_info(ydl, entry)
+                itemname = get_itemname(unresolved_entry)
+                if itemname in handled_items:
+                    # Already found in another playlist of this call
+                    skip_duplicate()
+                    return
+                # Items known to exist are skipped even without
+                # flat_playlist, which asks archive.org about the others.
+                if (resume_job(itemname) or
+                        (not ignore_existing_item and
+                         (is_known_to_exist(itemname) or
+                          (flat_playlist and
+                           check_if_ia_item_exists(unresolved_entry))))):
+                    ydl.record_download_archive(entry)
+                    return
+
+            with self.scheduler.slot(entry.get('ie_key')):
+                if entry_type == 'url':
+                    info_dict = ydl.extract_info(
+                        entry['url'], download=False, process=False,
+                        ie_key=entry.get('ie_key'))
+                else:
+                    # Let yt-dlp merge the fields of transparent urls
+                    info_dict = ydl.process_ie_result(
+                        entry, download=False, extra_info=extra_info)
+                    extra_info = None
+            ydl_progress_lazy(ydl, info_dict, extra_info)
+
         def ydl_progress_hook(d):
             if d['status'] == 'downloading' and self.verbose:
                 if d.get('_total_bytes_str') is not None:
@@ -174,27 +847,223 @@ class TubeUp(object):
                                              ydl_username, ydl_password,
                                              use_download_archive)
 
-        with YoutubeDL(ydl_opts) as ydl:
-            for url in urls:
-                if not ignore_existing_item:
-                    # Get the info dict of the url
-                    info_dict = ydl.extract_info(url, download=False)
+        # With more than one download worker, every worker thread downloads
+        # with its own YoutubeDL while the main YoutubeDL only extracts the
+        # playlists to hand their entries over to the workers.
+        executor = None
+        if self.download_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=self.download_workers)
+        ydl_key = (cookie_file, proxy_url, ydl_username, ydl_password,
+                   use_download_archive)
+        # Every worker keeps its YoutubeDL until the end of the call
+        worker_ydls = contextlib.ExitStack()
+        worker_local = threading.local()
+        pending_tasks = set()
+
+        def run_in_worker(func, *args):
+            worker_ydl = getattr(worker_local, 'ydl', None)
+            if worker_ydl is None:
+                with basenames_lock:
+                    worker_ydl = worker_local.ydl = worker_ydls.enter_context(
+                        self.open_ydl(ydl_opts, ydl_key))
+            func(worker_ydl, *args)
+
+        def finish_tasks(return_when=ALL_COMPLETED):
+            done, _ = wait(pending_tasks, return_when=return_when)
+            pending_tasks.difference_update(done)
+            for task in done:
+                task.result()
+
+        def dispatch(func, *args):
+            if executor is None:
+                func(ydl, *args)
+                return
+            # Only keep a few entries queued up for every worker
+            if len(pending_tasks) >= 2 * self.download_workers:
+                finish_tasks(FIRST_COMPLETED)
+            pending_tasks.add(executor.submit(run_in_worker, func, *args))
 
-                    if info_dict.get('_type', 'video') == 'playlist':
-                        for entry in info_dict['entries']:
-                            ydl_progress_each(entry)
+        try:
+            with self.open_ydl(ydl_opts, ydl_key) as ydl:
+                for url, ie, url_id in iter_unique_urls(urls):
+                    if (url_id is not None and
+                            getattr(ie, '_RETURN_TYPE', None) == 'video'):
+                        # Handled like a flat playlist entry, so a video
+                        # that has been handled already isn't extracted.
+                        dispatch(ydl_progress_lazy, {
+                            '_type': 'url', 'url': url, 'ie_key': ie.ie_key(),
+                            'id': url_id})
+                        continue
+
+                    with self.scheduler.slot(ie and ie.ie_key()):
+                        info_dict = ydl.extract_info(url, download=False,
+                                                     process=False)
+
+                    if info_dict and info_dict.get('_type') == 'playlist':
+                        for entry, extra_info in walk_playlist(ydl, info_dict):
+                            dispatch(ydl_progress_lazy, entry, extra_info)
                     else:
-                        ydl_progress_each(info_dict)
-                else:
-                    info_dict = ydl.extract_info(url)
-                    downloaded_files_basename.update(self.create_basenames_from_ydl_info_dict(ydl, info_dict))
+                        dispatch(ydl_progress_lazy, info_dict)
+                    del info_dict
+
+                finish_tasks()
+                move_sync_marks(ydl)
+
+            if saved_extractions:
+                msg = (':: Skipped %d duplicate url(s) and playlist entries, '
+                       'saving as many extractions' % saved_extractions)
+                self.logger.info(msg)
+                if self.verbose:
+                    print(msg)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if preflight_executor is not None:
+                preflight_executor.shutdown(cancel_futures=True)
+            worker_ydls.close()
 
         self.logger.debug(
-            'Basenames obtained from url (%s): %s'
-            % (url, downloaded_files_basename))
+            'Basenames obtained from the urls: %s' % downloaded_files_basename)
 
         return downloaded_files_basename
 
+    def ia_item_exists(self, itemname):
+        """
+        Check whether an item exists on archive.org, answers are cached in
+        `item_cache` across runs.
+
+        :param itemname:  Identifier of the archive.org item.
+        :return:          True if the item exists.
+        """
+        if itemname in self.existing_items:
+            return True
+
+        item_exists = self.item_cache.get(itemname)
+        if item_exists is None:
+            item_exists = check_identifier_exists(itemname, self.ia_session)
+            self.item_cache.set(itemname, item_exists)
+        return item_exists
+
+    def prefetch_existing_items(self, query):
+        """
+        Remember every archive.org item matching a search query as existing
+        for the rest of the run, with one paginated query instead of one
+        request per item. A query is only run once per run.
+
+        :param query:  An archive.org search query, e.g. a `channel` or
+                       `scanner` query.
+        :return:       Number of identifiers that have been fetched.
+        """
+        if query in self._prefetched_queries:
+            return 0
+        self._prefetched_queries.add(query)
+
+        count = 0
+        for identifier in iter_search_identifiers(query, self.ia_session):
+            self.existing_items.add(identifier)
+            count += 1
+
+        self.logger.debug('%d existing items fetched for query %s'
+                          % (count, query))
+        return count
+
+    @staticmethod
+    def build_channel_query(info_dict):
+        """
+        Build the archive.org search query matching the items uploaded from
+        the channel of a playlist.
+
+        :param info_dict:  A ydl info_dict of a playlist.
+        :return:           The search query, None if the playlist doesn't
+                           come from a channel.
+        """
+        channel_urls = set()
+        for key in ('uploader_url', 'channel_url'):
+            channel_url = info_dict.get(key)
+            if not channel_url:
+                continue
+            # Older items were uploaded with http channel urls
+            channel_urls.add(re.sub(r'^https?://', 'https://', channel_url))
+            channel_urls.add(re.sub(r'^https?://', 'http://', channel_url))
+
+        if not channel_urls:
+            return None
+        return ' OR '.join('channel:"%s"' % channel_url
+                           for channel_url in sorted(channel_urls))
+
+    def get_manifest(self, info_dict):
+        """
+        Get the manifest of the video of an info dict, the basename of the
+        video being found from its info.json.
+
+        :param info_dict:  An info dict passed to a yt-dlp hook.
+        :return:           A `JobManifest`, None if the info.json of the
+                           video hasn't been written.
+        """
+        infojson_filename = info_dict.get('infojson_filename')
+        if not infojson_filename:
+            return None
+        basename = infojson_filename[:-len('.info.json')]
+        return self.manifests.setdefault(basename, JobManifest())
+
+    def record_downloaded_file(self, d):
+        """
+        A yt-dlp progress hook adding every downloaded file to the manifest
+        of its video.
+        """
+        manifest = d['status'] == 'finished' and self.get_manifest(
+            d.get('info_dict') or {})
+        if manifest:
+            manifest.paths.add(d['filename'])
+
+    def record_postprocessed_files(self, d):
+        """
+        A yt-dlp post-processor hook adding the files of a video to its
+        manifest once they have been moved to their final place, which is
+        the last step of its download.
+        """
+        if d['status'] != 'finished' or d['postprocessor'] != 'MoveFiles':
+            return
+        info_dict = d['info_dict']
+        manifest = self.get_manifest(info_dict)
+        if manifest is None:
+            return
+
+        media_path = os.path.join(
+            info_dict.get('__finaldir', os.path.dirname(info_dict['filepath'])),
+            os.path.basename(info_dict['filepath']))
+        manifest.paths.add(media_path)
+        manifest.paths.add(info_dict['infojson_filename'])
+        # Subtitles and thumbnails
+        for old_path, new_path in info_dict.get('__files_to_move', {}).items():
+            manifest.paths.add(new_path or os.path.join(
+                os.path.dirname(media_path), os.path.basename(old_path)))
+        # No hook reports the description, it is named like the info.json
+        description_path = (info_dict['infojson_filename'][:-len('info.json')] +
+                            'description')
+        if os.path.exists(description_path):
+            manifest.paths.add(description_path)
+        manifest.complete = True
+
+    def is_download_complete(self, videobasename, info_dict=None):
+        """
+        Check whether yt-dlp has finished downloading a video, from its
+        manifest or, without one, from the files in its directory.
+
+        :param videobasename:  A video base name.
+        :param info_dict:      Info dict of the video, its selected formats
+                               tell the unmerged ones.
+        :return:               True if the media has been downloaded and no
+                               file is left in progress.
+        """
+        manifest = self.manifests.get(videobasename)
+        if manifest is not None:
+            return manifest.complete
+        if not os.path.exists(videobasename + '.info.json'):
+            return False
+        job_files = scan_job_files(videobasename, info_dict)
+        return bool(job_files.media) and not job_files.stubs
+
     def create_basenames_from_ydl_info_dict(self, ydl, info_dict):
         """
         Create basenames from YoutubeDL info_dict.
@@ -256,7 +1125,7 @@ class TubeUp(object):
         """
         ydl_opts = {
             'outtmpl': os.path.join(self.dir_path['downloads'],
-                                    self.output_template),
+                                    JOB_DIR_TEMPLATE, self.output_template),
             'restrictfilenames': True,
             'quiet': not self.verbose,
             'verbose': self.verbose,
@@ -288,7 +1157,9 @@ class TubeUp(object):
             # youtube-dl devs
             'call_home': False,
             'logger': self.logger,
-            'progress_hooks': [ydl_progress_hook]
+            'progress_hooks': [ydl_progress_hook,
+                               self.record_downloaded_file],
+            'postprocessor_hooks': [self.record_postprocessed_files]
         }
 
         if cookie_file is not None:
@@ -304,8 +1175,7 @@ class TubeUp(object):
             ydl_opts['password'] = ydl_password
 
         if use_download_archive:
-            ydl_opts['download_archive'] = os.path.join(self.dir_path['root'],
-                                                        '.ytdlarchive')
+            ydl_opts['download_archive'] = self.download_archive
 
         return ydl_opts
 
@@ -324,38 +1194,56 @@ class TubeUp(object):
         with open(json_metadata_filepath, 'r', encoding='utf-8') as f:
             vid_meta = json.load(f)
 
+        # The files yt-dlp has reported, or the ones found in the downloads
+        # folder for videos downloaded by another run.
+        manifest = self.manifests.pop(videobasename, None)
+        if manifest is not None:
+            download_complete = manifest.complete
+            job_files = [path for path in manifest.paths
+                         if os.path.exists(path)]
+        else:
+            scanned_files = scan_job_files(videobasename, vid_meta)
+            download_complete = not scanned_files.stubs
+            job_files = scanned_files.media + scanned_files.sidecars
+
         # Exit if video download did not complete, don't upload .part files to IA
-        for ext in ['*.part', '*.f303.*', '*.f302.*', '*.ytdl', '*.f251.*', '*.248.*', '*.f247.*', '*.temp']:
-            if glob.glob(videobasename + ext):
-                msg = 'Video download incomplete, please re-run or delete video stubs in downloads folder, exiting...'
-                raise Exception(msg)
+        if not download_complete:
+            msg = 'Video download incomplete, please re-run or delete video stubs in downloads folder, exiting...'
+            raise Exception(msg)
 
         itemname = get_itemname(vid_meta)
         metadata = self.create_archive_org_metadata_from_youtubedl_meta(
             vid_meta)
 
+        job_files = {os.path.basename(os.fspath(job_file)): job_file
+                     for job_file in job_files}
+        filename_prefix = os.path.basename(videobasename)
+
         # Delete empty description file
-        description_file_path = videobasename + '.description'
-        if (os.path.exists(description_file_path) and
+        description_file = job_files.get(filename_prefix + '.description')
+        if (description_file is not None and
             (('description' in vid_meta and
              vid_meta['description'] == '') or
-                check_is_file_empty(description_file_path))):
-            os.remove(description_file_path)
+                check_is_file_empty(description_file))):
+            os.remove(description_file)
+            del job_files[filename_prefix + '.description']
 
         # Delete empty annotations.xml file so it isn't uploaded
-        annotations_file_path = videobasename + '.annotations.xml'
-        if (os.path.exists(annotations_file_path) and
+        annotations_file = job_files.get(filename_prefix + '.annotations.xml')
+        if (annotations_file is not None and
             (('annotations' in vid_meta and
              vid_meta['annotations'] in {'', EMPTY_ANNOTATION_FILE}) or
-                check_is_file_empty(annotations_file_path))):
-            os.remove(annotations_file_path)
+                check_is_file_empty(annotations_file))):
+            os.remove(annotations_file)
+            del job_files[filename_prefix + '.annotations.xml']
 
         # Upload all files with videobase name: e.g. video.mp4,
         # video.info.json, video.srt, etc.
-        files_to_upload = glob.glob(videobasename + '*')
+        files_to_upload = [os.fspath(job_file)
+                           for job_file in job_files.values()]
 
         # Upload the item to the Internet Archive
-        item = internetarchive.get_item(itemname)
+        item = self.ia_session.get_item(itemname)
 
         if custom_meta:
             metadata.update(custom_meta)
@@ -374,18 +1262,129 @@ class TubeUp(object):
                 print(msg)
             raise Exception(msg)
 
-        item.upload(files_to_upload, metadata=metadata, retries=9001,
-                    request_kwargs=dict(timeout=(9001, 9001)), delete=True,
-                    verbose=self.verbose, access_key=s3_access_key,
-                    secret_key=s3_secret_key)
+        upload_kwargs = dict(metadata=metadata, retries=9001,
+                             request_kwargs=dict(timeout=(9001, 9001)),
+                             delete=True, verbose=self.verbose,
+                             access_key=s3_access_key,
+                             secret_key=s3_secret_key)
+
+        # Large files are uploaded in parts after the other files, the
+        # derive being queued with the last of them. The other files, the
+        # .info.json among them, are only deleted once they are all
+        # uploaded, an interrupted upload in parts is resumed from them.
+        large_files = []
+        if self.multipart_threshold is not None:
+            large_files = [file_path for file_path in files_to_upload
+                           if os.path.getsize(file_path) >= self.multipart_threshold]
+            files_to_upload = [file_path for file_path in files_to_upload
+                               if file_path not in large_files]
+        queue_derive = not large_files
+        upload_kwargs['delete'] = not large_files
+
+        if self.file_upload_workers > 1 and len(files_to_upload) > 2:
+            self.upload_files_concurrently(item, files_to_upload,
+                                           queue_derive=queue_derive,
+                                           **upload_kwargs)
+        else:
+            item.upload(files_to_upload, queue_derive=queue_derive,
+                        **upload_kwargs)
+
+        s3_auth = S3Auth(s3_access_key, s3_secret_key)
+        try:
+            for index, file_path in enumerate(large_files):
+                self.upload_file_in_parts(
+                    item, file_path, s3_auth,
+                    queue_derive=index == len(large_files) - 1)
+        except Exception as e:
+            raise MultipartUploadInterrupted(
+                'The upload of %s in parts was interrupted: %s'
+                % (videobasename, e)) from e
+        if large_files:
+            for file_path in files_to_upload:
+                os.remove(file_path)
+
+        self.item_cache.set(itemname, True)
+
+        # The uploaded files have been deleted, remove their job directory
+        # unless the video was downloaded before there were job directories.
+        job_dir = os.path.dirname(videobasename)
+        if job_dir != self.dir_path['downloads']:
+            try:
+                os.rmdir(job_dir)
+            except OSError:
+                pass
 
         return itemname, metadata
 
+    def upload_files_concurrently(self, item, files_to_upload,
+                                  queue_derive=True, **kwargs):
+        """
+        Upload the files of one item to archive.org at the same time.
+
+        The smallest file is uploaded alone first so it creates the bucket,
+        and the derive is queued with the second smallest file, which is
+        uploaded alone after all the other files have been uploaded.
+
+        :param item:             An `internetarchive.Item` to upload to.
+        :param files_to_upload:  List of file paths, at least three.
+        :param queue_derive:     Queue the derive with the last file, False
+                                 when more files will be uploaded after.
+        :param kwargs:           Keyword arguments that will be passed to
+                                 `internetarchive.Item.upload_file`.
+        """
+        files_to_upload = sorted(files_to_upload, key=os.path.getsize)
+        total_size = sum(os.path.getsize(f) for f in files_to_upload)
+        kwargs['headers'] = {'x-archive-size-hint': str(total_size)}
+
+        first_file, last_file = files_to_upload[:2]
+        item.upload_file(first_file, queue_derive=False, **kwargs)
+
+        with ThreadPoolExecutor(
+                max_workers=self.file_upload_workers) as executor:
+            uploads = [executor.submit(item.upload_file, file_path,
+                                       queue_derive=False, **kwargs)
+                       for file_path in files_to_upload[2:]]
+            for upload in uploads:
+                upload.result()
+
+        item.upload_file(last_file, queue_derive=queue_derive, **kwargs)
+
+    def upload_file_in_parts(self, item, file_path, auth, queue_derive=True):
+        """
+        Upload a large file to archive.org with a multipart upload, then
+        delete it. An interrupted upload is resumed by the next call.
+
+        :param item:          An `internetarchive.Item` to upload to.
+        :param file_path:     Path of the file.
+        :param auth:          An `internetarchive.auth.S3Auth`.
+        :param queue_derive:  Queue the derive of the item once the file has
+                              been uploaded.
+        """
+        url = '%s//%s/%s/%s' % (self.ia_session.protocol, S3_HOST,
+                                item.identifier,
+                                quote(os.path.basename(file_path)))
+        headers = {'x-archive-auto-make-bucket': '1',
+                   'x-archive-queue-derive': '1' if queue_derive else '0',
+                   'x-archive-size-hint': str(os.path.getsize(file_path))}
+
+        msg = ' uploading %s in parts' % file_path
+        self.logger.info(msg)
+        if self.verbose:
+            print(msg)
+        MultipartUpload(self.ia_session, url, file_path,
+                        workers=self.multipart_workers, retries=9001,
+                        headers=headers, auth=auth,
+                        store=self.multipart_uploads).upload()
+        os.remove(file_path)
+
     def archive_urls(self, urls, custom_meta=None,
                      cookie_file=None, proxy=None,
                      ydl_username=None, ydl_password=None,
                      use_download_archive=False,
-                     ignore_existing_item=False):
+                     ignore_existing_item=False,
+                     flat_playlist=False,
+                     cancel_event=None,
+                     resume=True):
         """
         Download and upload videos from youtube_dl supported sites to
         archive.org
@@ -405,16 +1404,485 @@ class TubeUp(object):
                                       the archive file. Record the IDs of all
                                       downloaded videos in it.
         :param ignore_existing_item:  Ignores the check for existing items on archive.org.
+        :param flat_playlist:         Check playlist entries against archive.org
+                                      before extracting them, only the entries that
+                                      don't exist on archive.org yet get extracted.
+        :param cancel_event:          A `threading.Event`, once it's set no more
+                                      video is downloaded or uploaded and
+                                      `ArchivingCancelled` is raised.
+        :param resume:                Upload the videos a previous run has
+                                      downloaded but not uploaded first.
         :return:                      Tuple containing identifier and metadata of the
                                       file that has been uploaded to archive.org.
         """
-        downloaded_file_basenames = self.get_resource_basenames(
-            urls, cookie_file, proxy, ydl_username, ydl_password, use_download_archive,
-            ignore_existing_item)
-        for basename in downloaded_file_basenames:
-            identifier, meta = self.upload_ia(basename, custom_meta)
+        # Upload what a previous run has downloaded but not uploaded first
+        resumed_basenames = []
+        if resume:
+            resumed_basenames = [
+                basename for _, basename in self.job_store.jobs_in_state('downloaded')
+                if os.path.exists(basename + '.info.json')]
+        if resumed_basenames and self.verbose:
+            print(':: Resuming the upload of %d downloaded video(s)'
+                  % len(resumed_basenames))
+
+        if self.pipeline_depth:
+            downloaded_file_basenames = self.iter_pipelined_basenames(
+                urls, cookie_file, proxy, ydl_username, ydl_password, use_download_archive,
+                ignore_existing_item, flat_playlist=flat_playlist,
+                cancel_event=cancel_event)
+        else:
+            downloaded_file_basenames = self.get_resource_basenames(
+                urls, cookie_file, proxy, ydl_username, ydl_password, use_download_archive,
+                ignore_existing_item, flat_playlist=flat_playlist,
+                cancel_event=cancel_event)
+        downloaded_file_basenames = itertools.chain(
+            resumed_basenames,
+            (basename for basename in downloaded_file_basenames
+             if basename not in resumed_basenames))
+        for identifier, meta in self.upload_basenames(
+                downloaded_file_basenames, custom_meta, cancel_event):
             yield identifier, meta
 
+    def archive_batch_file(self, batch_file, *args, **kwargs):
+        """
+        Archive the urls of a batch file, reading it as the archiving goes.
+
+        The urls are handed to `archive_urls` in chunks of `BATCH_CHUNK_SIZE`
+        and the position in the file is saved after every chunk, so an
+        interrupted run starts again with the chunk that was being archived.
+        The chunks share their YoutubeDL instances, and a url found among
+        the last `BATCH_SEEN_URLS` urls of the earlier chunks is skipped like
+        a duplicate of its own chunk. An older duplicate is only extracted
+        again, the job of its video keeps it from being archived twice.
+
+        :param batch_file:  Path of a file with one url per line, - to read
+                            the urls from stdin, which can't be resumed.
+        :param args:        Positional arguments passed to `archive_urls`.
+        :param kwargs:      Keyword arguments passed to `archive_urls`.
+        :return:            A generator of tuples containing identifier and
+                            metadata of the items uploaded to archive.org.
+        """
+        if batch_file == '-':
+            yield from self._archive_batch(sys.stdin.buffer, None, 0,
+                                           *args, **kwargs)
+            return
+
+        checkpoint_path = os.path.realpath(batch_file)
+        offset = self.batch_checkpoints.get(checkpoint_path)
+        with open(batch_file, 'rb') as f:
+            if offset > os.fstat(f.fileno()).st_size:
+                self.logger.warning('%s is shorter than its checkpoint, '
+                                    'starting it over' % batch_file)
+                offset = 0
+            elif offset and self.verbose:
+                print(':: Resuming %s at byte %d' % (batch_file, offset))
+            f.seek(offset)
+            yield from self._archive_batch(f, checkpoint_path, offset,
+                                           *args, **kwargs)
+
+    def _archive_batch(self, f, checkpoint_path, offset, *args, **kwargs):
+        urls = iter_batch_file(f, offset)
+        self._seen_urls = RecentKeys(BATCH_SEEN_URLS)
+        try:
+            with self.warm_ydls():
+                resume = True
+                while True:
+                    chunk = list(itertools.islice(urls, BATCH_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    # Only the first chunk looks for the downloads of a
+                    # previous run
+                    yield from self.archive_urls([url for url, _ in chunk],
+                                                 *args, resume=resume,
+                                                 **kwargs)
+                    resume = False
+                    if checkpoint_path is not None:
+                        self.batch_checkpoints.set(checkpoint_path,
+                                                   chunk[-1][1])
+        finally:
+            self._seen_urls = None
+
+    def upload_basenames(self, basenames, custom_meta=None, cancel_event=None):
+        """
+        Upload the downloaded videos to archive.org.
+
+        With more than one upload worker the videos are uploaded at the same
+        time and the results are yielded in the order the uploads finish. A
+        failing upload doesn't stop the other ones, an exception is raised
+        after all the other uploads have finished instead.
+
+        :param basenames:    An iterable of videos basename that have been
+                             downloaded.
+        :param custom_meta:  A custom meta, will be used by internetarchive
+                             library when uploading to archive.org.
+        :param cancel_event: A `threading.Event`, once it's set no more
+                             upload is started and `ArchivingCancelled` is
+                             raised.
+        :return:             A generator of tuples containing identifier and
+                             metadata of the items uploaded to archive.org.
+        """
+        if self.upload_workers <= 1:
+            for basename in basenames:
+                _raise_if_cancelled(cancel_event)
+                yield self.upload_job(basename, custom_meta)
+            return
+
+        basenames = iter(basenames)
+        pending_uploads = {}
+        failed_uploads = []
+        no_more_basenames = False
+        cancelled = False
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            while pending_uploads or not no_more_basenames:
+                while (not no_more_basenames and
+                       len(pending_uploads) < self.upload_workers):
+                    # Raised once the running uploads have finished
+                    cancelled = (cancel_event is not None and
+                                 cancel_event.is_set())
+                    basename = None if cancelled else next(basenames, None)
+                    if basename is None:
+                        no_more_basenames = True
+                    else:
+                        upload = executor.submit(self.upload_job, basename,
+                                                 custom_meta)
+                        pending_uploads[upload] = basename
+
+                if not pending_uploads:
+                    break
+
+                done, _ = wait(pending_uploads, return_when=FIRST_COMPLETED)
+                for upload in done:
+                    basename = pending_uploads.pop(upload)
+                    error = upload.exception()
+                    if error is None:
+                        yield upload.result()
+                        continue
+
+                    msg = 'Failed to upload %s: %s' % (basename, error)
+                    self.logger.error(msg)
+                    if self.verbose:
+                        print(msg)
+                    failed_uploads.append(error)
+
+        if cancelled:
+            raise ArchivingCancelled('The archiving has been cancelled')
+        if failed_uploads:
+            raise Exception('%d upload(s) failed, the first error was: %s'
+                            % (len(failed_uploads), failed_uploads[0])) from failed_uploads[0]
+
+    def upload_job(self, videobasename, custom_meta=None):
+        """
+        Upload a video with `upload_ia` and record the new state of its job,
+        the job is verified once its item can be found on archive.org.
+
+        :param videobasename:  A video base name.
+        :param custom_meta:    A custom meta, will be used by internetarchive
+                               library when uploading to archive.org.
+        :return:               A tuple containing item name and metadata used
+                               when uploading to archive.org.
+        """
+        try:
+            itemname, metadata = self.upload_ia(videobasename, custom_meta)
+        except MultipartUploadInterrupted:
+            # The job stays downloaded, the next run resumes the upload
+            raise
+        except Exception as e:
+            self.job_store.fail_basename(videobasename, str(e))
+            raise
+        finally:
+            self.disk_space.freed(videobasename)
+        self.job_store.set_state(itemname, 'uploaded', videobasename)
+
+        try:
+            if check_identifier_exists(itemname, self.ia_session):
+                self.job_store.set_state(itemname, 'verified')
+        except requests.exceptions.RequestException as e:
+            # The job stays uploaded, it isn't uploaded again
+            self.logger.warning('Unable to verify %s: %s' % (itemname, e))
+
+        return itemname, metadata
+
+    def iter_pipelined_basenames(self, urls, *args, **kwargs):
+        """
+        Download the urls in a background thread and yield every basename as
+        soon as its download has finished.
+
+        The download thread blocks once `pipeline_depth` finished downloads
+        are waiting to be consumed, so the downloads directory never holds
+        much more than that many videos. When the consumer stops early, on an
+        upload error or by closing the generator, the download thread stops
+        at the next download it hands over.
+
+        :param urls:    A list of urls that will be downloaded with youtubedl.
+        :param args:    Positional arguments passed to
+                        `get_resource_basenames`.
+        :param kwargs:  Keyword arguments passed to `get_resource_basenames`.
+        :return:        A generator of videos basename that has been
+                        downloaded.
+        """
+        basenames_queue = queue.Queue(maxsize=self.pipeline_depth)
+        download_errors = []
+        # Set once the consumer doesn't take any more basenames
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    basenames_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def hand_over(basename):
+            # Its upload deletes its files, downloads that don't fit on the
+            # disk wait for it.
+            self.disk_space.expect_free(basename)
+            if not put(basename):
+                raise _PipelineStopped()
+
+        def download_stage():
+            try:
+                self.get_resource_basenames(
+                    urls, *args, basename_callback=hand_over, **kwargs)
+            except _PipelineStopped:
+                pass
+            except Exception as e:
+                download_errors.append(e)
+            finally:
+                put(_PIPELINE_DONE)
+
+        # Daemonized so a download in progress doesn't keep the process alive
+        # after the consumer has stopped.
+        download_thread = threading.Thread(target=download_stage, daemon=True)
+        download_thread.start()
+
+        try:
+            while True:
+                basename = basenames_queue.get()
+                if basename is _PIPELINE_DONE:
+                    break
+                yield basename
+        finally:
+            stopped.set()
+            # Wake up the download thread if it waits for room on the queue
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    basenames_queue.get_nowait()
+
+        download_thread.join()
+        if download_errors:
+            raise download_errors[0]
+
+    def enqueue_urls(self, job_queue, urls,
+                     cookie_file=None, proxy_url=None,
+                     ydl_username=None, ydl_password=None):
+        """
+        Add the videos of urls to a job queue for `run_worker`. Playlists
+        are only enumerated, every one of their videos is queued on its own
+        so the videos get spread over the workers.
+
+        :param job_queue:     A `JobQueue`.
+        :param urls:          A list of urls that will be queued.
+        :param cookie_file:   A cookie file for YoutubeDL.
+        :param proxy_url:     A proxy url for YoutubeDL.
+        :param ydl_username:  Username that will be used to enumerate the
+                              urls with youtube_dl.
+        :param ydl_password:  Password of the related username.
+        :return:              Number of urls that have been added to the
+                              queue.
+        """
+        def iter_video_urls(ydl, url):
+            info_dict = ydl.extract_info(url, download=False, process=False)
+            if not info_dict:
+                self.logger.warning('"%s" is not available. Skipping.' % url)
+                return
+            if info_dict.get('_type') in ('url', 'url_transparent'):
+                # Only a redirection, e.g. from a short url
+                yield from iter_entry_urls(ydl, info_dict)
+            elif info_dict.get('_type') == 'playlist':
+                for entry in info_dict.get('entries') or []:
+                    yield from iter_entry_urls(ydl, entry)
+            else:
+                yield url
+
+        def iter_entry_urls(ydl, entry):
+            # The entries of a channel are the playlists of its tabs, which
+            # are enumerated in turn so only videos get queued.
+            if not entry:
+                return
+            if entry.get('_type') == 'playlist':
+                for nested_entry in entry.get('entries') or []:
+                    yield from iter_entry_urls(ydl, nested_entry)
+                return
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if not entry_url:
+                return
+            if is_video_entry(ydl, entry):
+                yield entry_url
+            else:
+                yield from iter_video_urls(ydl, entry_url)
+
+        ydl_opts = self.generate_ydl_options(lambda d: None,
+                                             cookie_file, proxy_url,
+                                             ydl_username, ydl_password)
+        count = 0
+        with YoutubeDL(ydl_opts) as ydl:
+            video_urls = itertools.chain.from_iterable(
+                iter_video_urls(ydl, url) for url in urls)
+            while True:
+                batch = list(itertools.islice(video_urls, ENQUEUE_BATCH_SIZE))
+                if not batch:
+                    break
+                count += job_queue.enqueue(batch)
+        return count
+
+    def run_worker(self, job_queue, worker, custom_meta=None,
+                   cookie_file=None, proxy=None,
+                   ydl_username=None, ydl_password=None,
+                   use_download_archive=False,
+                   ignore_existing_item=False,
+                   flat_playlist=False,
+                   lease_time=300, poll_interval=30,
+                   exit_when_empty=False):
+        """
+        Archive the urls of a job queue shared with other workers.
+
+        Every url is leased while it's archived with `archive_urls`, the
+        lease is renewed every third of `lease_time`. The url of a worker
+        that dies is handed to another worker once its lease has expired.
+        A worker that has lost the lease of its url, its heartbeats having
+        failed for too long, stops archiving it before the next download or
+        upload. The parameters that aren't described here are the ones of
+        `archive_urls`.
+
+        :param job_queue:             A `JobQueue`.
+        :param worker:                Name of this worker, unique among the
+                                      workers of the queue.
+        :param custom_meta:           A custom metadata that will be used when
+                                      uploading the file with archive.org.
+        :param lease_time:            Number of seconds a url is leased for
+                                      without a heartbeat.
+        :param poll_interval:         Number of seconds to wait for new urls
+                                      when the queue is empty.
+        :param exit_when_empty:       Return once the queue is empty instead
+                                      of waiting for new urls.
+        :return:                      A generator of tuples containing
+                                      identifier and metadata of the items
+                                      uploaded to archive.org.
+        """
+        def send_heartbeats(job_id, url, stopped, lease_lost):
+            while not stopped.wait(lease_time / 3):
+                try:
+                    renewed = job_queue.heartbeat(job_id, worker, lease_time)
+                except sqlite3.Error as e:
+                    # e.g. the database is locked, tried again until the
+                    # lease has expired
+                    self.logger.warning('Unable to renew the lease of %s: %s'
+                                        % (url, e))
+                    continue
+                if not renewed:
+                    self.logger.warning('Lost the lease of %s' % url)
+                    lease_lost.set()
+                    return
+
+        while True:
+            job = job_queue.claim(worker, lease_time)
+            if job is None:
+                if exit_when_empty:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            job_id, url = job
+            stopped = threading.Event()
+            lease_lost = threading.Event()
+            heartbeat_thread = threading.Thread(
+                target=send_heartbeats, args=(job_id, url, stopped, lease_lost),
+                daemon=True)
+            heartbeat_thread.start()
+            try:
+                for identifier, meta in self.archive_urls(
+                        [url], custom_meta, cookie_file, proxy,
+                        ydl_username, ydl_password, use_download_archive,
+                        ignore_existing_item, flat_playlist=flat_playlist,
+                        cancel_event=lease_lost):
+                    yield identifier, meta
+            except ArchivingCancelled:
+                # The url belongs to the worker that has taken it over
+                msg = 'Stopped archiving %s, its lease has been lost' % url
+                self.logger.error(msg)
+                if self.verbose:
+                    print(msg)
+            except Exception as e:
+                msg = 'Failed to archive %s: %s' % (url, e)
+                self.logger.error(msg)
+                if self.verbose:
+                    print(msg)
+                job_queue.fail(job_id, worker, str(e))
+            else:
+                job_queue.complete(job_id, worker)
+            finally:
+                stopped.set()
+                heartbeat_thread.join()
+
+    def run_daemon(self, channels, custom_meta=None,
+                   cookie_file=None, proxy=None,
+                   ydl_username=None, ydl_password=None,
+                   use_download_archive=False,
+                   ignore_existing_item=False,
+                   flat_playlist=False,
+                   stop_event=None):
+        """
+        Archive the new videos of channels until `stop_event` is set, every
+        channel being polled on its own interval.
+
+        The YoutubeDL instances are kept between the polls. Before being
+        extracted, the videos handled by an earlier poll are skipped with
+        the job store, and the videos found on archive.org by an earlier
+        poll with the item cache, so a video already archived by someone
+        else is only extracted by the first poll. The parameters that
+        aren't described here are the ones of `archive_urls`.
+
+        :param channels:    List of tuples of the url of a channel and the
+                            number of seconds between two of its polls.
+        :param stop_event:  A `threading.Event` that stops the daemon once
+                            the running poll has finished.
+        :return:            A generator of tuples containing identifier and
+                            metadata of the items uploaded to archive.org.
+        """
+        if stop_event is None:
+            stop_event = threading.Event()
+
+        # Heap of the next poll time of every channel, the index keeps the
+        # order of the channels file for polls due at the same time.
+        next_polls = [(time.monotonic(), index, url, interval)
+                      for index, (url, interval) in enumerate(channels)]
+        heapq.heapify(next_polls)
+
+        with self.warm_ydls():
+            while next_polls:
+                poll_time, index, url, interval = next_polls[0]
+                if stop_event.wait(max(0, poll_time - time.monotonic())):
+                    break
+
+                started = time.monotonic()
+                try:
+                    for identifier, meta in self.archive_urls(
+                            [url], custom_meta, cookie_file, proxy,
+                            ydl_username, ydl_password, use_download_archive,
+                            ignore_existing_item, flat_playlist=flat_playlist):
+                        yield identifier, meta
+                except Exception as e:
+                    # A failing channel is polled again on its next turn
+                    msg = 'Failed to poll %s: %s' % (url, e)
+                    self.logger.error(msg)
+                    if self.verbose:
+                        print(msg)
+                heapq.heapreplace(next_polls,
+                                  (started + interval, index, url, interval))
+
     @staticmethod
     def determine_collection_type(url):
         """
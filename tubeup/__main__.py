@@ -18,14 +18,88 @@
 """tubeup - Download a video with Youtube-dlc, then upload to Internet Archive, passing all metadata.
 
 Usage:
-  tubeup <url>... [--username <user>] [--password <pass>]
-                  [--metadata=<key:value>...]
-                  [--cookies=<filename>]
-                  [--proxy <prox>]
-                  [--quiet] [--debug]
-                  [--use-download-archive]
-                  [--output <output>]
-                  [--ignore-existing-item]
+  tubeup enqueue <queue> <url>... [--username <user>] [--password <pass>]
+                                  [--cookies=<filename>] [--proxy <prox>]
+                                  [--quiet] [--debug]
+  tubeup worker <queue> [--worker-id <id>] [--lease-time <secs>]
+                        [--poll-interval <secs>] [--exit-when-empty]
+                        [--username <user>] [--password <pass>]
+                        [--metadata=<key:value>...]
+                        [--cookies=<filename>]
+                        [--proxy <prox>]
+                        [--quiet] [--debug]
+                        [--use-download-archive]
+                        [--output <output>]
+                        [--ignore-existing-item]
+                        [--pipeline-depth <n>]
+                        [--download-workers <n>]
+                        [--upload-workers <n>]
+                        [--file-upload-workers <n>]
+                        [--flat-playlist]
+                        [--preflight-workers <n>]
+                        [--missing-item-ttl <secs>]
+                        [--bulk-prefetch] [--prefetch-query <query>...]
+                        [--download-archive-backend <backend>]
+                        [--incremental-sync]
+                        [--extractor-limit <limit>...]
+                        [--bandwidth-limit <rate>]
+                        [--download-share <fraction>]
+                        [--bandwidth-file <path>]
+                        [--min-free-space <size>]
+                        [--multipart-threshold <size>]
+                        [--multipart-workers <n>]
+  tubeup daemon <channels-file> [--channel-interval <secs>]
+                                [--username <user>] [--password <pass>]
+                                [--metadata=<key:value>...]
+                                [--cookies=<filename>]
+                                [--proxy <prox>]
+                                [--quiet] [--debug]
+                                [--use-download-archive]
+                                [--output <output>]
+                                [--ignore-existing-item]
+                                [--pipeline-depth <n>]
+                                [--download-workers <n>]
+                                [--upload-workers <n>]
+                                [--file-upload-workers <n>]
+                                [--flat-playlist]
+                                [--preflight-workers <n>]
+                                [--missing-item-ttl <secs>]
+                                [--bulk-prefetch] [--prefetch-query <query>...]
+                                [--download-archive-backend <backend>]
+                                [--incremental-sync]
+                                [--extractor-limit <limit>...]
+                                [--bandwidth-limit <rate>]
+                                [--download-share <fraction>]
+                                [--bandwidth-file <path>]
+                                [--min-free-space <size>]
+                                [--multipart-threshold <size>]
+                                [--multipart-workers <n>]
+  tubeup (<url>... | --batch-file <path>)
+         [--username <user>] [--password <pass>]
+         [--metadata=<key:value>...]
+         [--cookies=<filename>]
+         [--proxy <prox>]
+         [--quiet] [--debug]
+         [--use-download-archive]
+         [--output <output>]
+         [--ignore-existing-item]
+         [--pipeline-depth <n>]
+         [--download-workers <n>]
+         [--upload-workers <n>]
+         [--file-upload-workers <n>]
+         [--flat-playlist]
+         [--preflight-workers <n>]
+         [--missing-item-ttl <secs>]
+         [--bulk-prefetch] [--prefetch-query <query>...]
+         [--download-archive-backend <backend>]
+         [--incremental-sync]
+         [--extractor-limit <limit>...]
+         [--bandwidth-limit <rate>]
+         [--download-share <fraction>]
+         [--bandwidth-file <path>]
+         [--min-free-space <size>]
+         [--multipart-threshold <size>]
+         [--multipart-workers <n>]
   tubeup -h | --help
   tubeup --version
 
@@ -33,6 +107,11 @@ Arguments:
   <url>                         Youtube-dlc compatible URL to download.
                                 Check Youtube-dlc documentation for a list
                                 of compatible websites.
+  <queue>                       Path of the job queue shared by the workers,
+                                e.g. on network storage.
+  <channels-file>               File of the channels polled by the daemon, one
+                                url per line optionally followed by its
+                                polling interval in seconds.
   --metadata=<key:value>        Custom metadata to add to the archive.org
                                 item.
 
@@ -48,16 +127,99 @@ Options:
   -q --quiet                   Just print errors.
   -d --debug                   Print all logs to stdout.
   -o --output <output>         Youtube-dlc output template.
+                               Every video is saved in its own directory of
+                               the downloads directory.
   -i --ignore-existing-item    Don't check if an item already exists on archive.org
+  --pipeline-depth <n>         Upload every video as soon as its download has
+                               finished, letting at most <n> downloaded videos
+                               wait for upload.
+  --download-workers <n>       Download <n> videos at the same time [default: 1].
+  --upload-workers <n>         Upload <n> items at the same time [default: 1].
+  --file-upload-workers <n>    Upload <n> files of the same item at the same
+                               time [default: 1].
+  --flat-playlist              Check playlist entries against archive.org
+                               before extracting them, only the missing ones
+                               get extracted.
+  --preflight-workers <n>      Check <n> upcoming playlist entries against
+                               archive.org at the same time while the current
+                               ones are downloaded [default: 4].
+  --missing-item-ttl <secs>    Number of seconds items missing from
+                               archive.org are remembered before checking them
+                               again, existing items are remembered for good
+                               [default: 86400].
+  --bulk-prefetch              Fetch the items of a channel that already exist
+                               on archive.org with a single search query before
+                               checking its videos.
+  --prefetch-query <query>     Treat the items matching this archive.org search
+                               query, e.g. a scanner query, as existing.
+  --download-archive-backend <backend>
+                               Store the download archive in a 'text' file
+                               or in an indexed 'sqlite' database, which
+                               imports the text file [default: text].
+  --worker-id <id>             Name of the worker in the job queue, the host
+                               name and the process id by default.
+  --lease-time <secs>          Number of seconds a worker keeps a url without
+                               a heartbeat before another worker may take it
+                               [default: 300].
+  --poll-interval <secs>       Number of seconds a worker waits for new urls
+                               when the queue is empty [default: 30].
+  --exit-when-empty            Stop the worker once the queue is empty.
+  --channel-interval <secs>    Number of seconds between two polls of the
+                               channels without an interval [default: 3600].
+  --extractor-limit <limit>    Limit an extractor, e.g. Youtube:2:0.5 lets two
+                               extractions or downloads of Youtube videos run
+                               at the same time and starts at most one every
+                               two seconds. The rate can be left out and an
+                               empty concurrency means no concurrency limit.
+  --batch-file <path>          Read the urls from a file, one per line, or
+                               from stdin when the path is -. The progress
+                               through a file is saved and an interrupted
+                               run starts again where it stopped.
+  --incremental-sync           Stop walking a channel at the newest video
+                               archived by an earlier run along with all the
+                               older ones. Only for playlists listing their
+                               newest videos first.
+  --bandwidth-limit <rate>     Share <rate> bytes per second, e.g. 10M, between
+                               all the downloads and uploads.
+  --download-share <fraction>  Give this part of the bandwidth limit, e.g.
+                               0.7, to the downloads and the rest to the
+                               uploads, 0 and 1 excluded. By default every
+                               running download and upload gets the same
+                               part of it.
+  --bandwidth-file <path>      Read the bandwidth limit, optionally followed
+                               by the download share, from a file, which is
+                               read again when tubeup gets a SIGHUP. The
+                               fragmented downloads, e.g. HLS or DASH, keep
+                               the rate they started with.
+  --min-free-space <size>      Only start a download while its estimated size
+                               leaves at least <size> bytes, e.g. 5G, free on
+                               the disk. Downloads wait for the uploads to
+                               free space, or are skipped until a later run
+                               when nothing will.
+  --multipart-threshold <size>
+                               Upload the files of at least <size> bytes,
+                               e.g. 1G, in parts of 64MiB sent at the same
+                               time, <size> must be larger than a part. A
+                               failed part is retried on its own and an
+                               interrupted upload is resumed by the next run.
+  --multipart-workers <n>      Upload <n> parts of a file at the same time
+                               [default: 4].
 """
 
+import os
 import sys
 import docopt
+import signal
+import socket
 import logging
+import threading
 import traceback
 
-from tubeup.utils import key_value_to_dict
+from yt_dlp.utils import parse_bytes
+from tubeup.utils import key_value_to_dict, parse_channels_file
 from tubeup.TubeUp import TubeUp
+from tubeup.scheduling import parse_extractor_limits, read_bandwidth_file
+from tubeup.state import JobQueue
 from tubeup import __version__
 
 
@@ -74,6 +236,41 @@ def main():
     debug_mode = args['--debug']
     use_download_archive = args['--use-download-archive']
     ignore_existing_item = args['--ignore-existing-item']
+    flat_playlist = args['--flat-playlist']
+    pipeline_depth = int(args['--pipeline-depth'] or 0)
+    download_workers = int(args['--download-workers'])
+    upload_workers = int(args['--upload-workers'])
+    file_upload_workers = int(args['--file-upload-workers'])
+    preflight_workers = int(args['--preflight-workers'])
+    missing_item_ttl = int(args['--missing-item-ttl'])
+    bulk_prefetch = args['--bulk-prefetch']
+    download_archive_backend = args['--download-archive-backend']
+    incremental_sync = args['--incremental-sync']
+    extractor_limits = parse_extractor_limits(args['--extractor-limit'])
+    bandwidth_limit = None
+    if args['--bandwidth-limit']:
+        bandwidth_limit = parse_bytes(args['--bandwidth-limit'])
+        if bandwidth_limit is None:
+            raise ValueError('Invalid bandwidth limit %r'
+                             % args['--bandwidth-limit'])
+    download_share = None
+    if args['--download-share']:
+        download_share = float(args['--download-share'])
+    bandwidth_file = args['--bandwidth-file']
+    multipart_threshold = None
+    if args['--multipart-threshold']:
+        multipart_threshold = parse_bytes(args['--multipart-threshold'])
+        if multipart_threshold is None:
+            raise ValueError('Invalid multipart threshold %r'
+                             % args['--multipart-threshold'])
+    min_free_space = None
+    if args['--min-free-space']:
+        min_free_space = parse_bytes(args['--min-free-space'])
+        if min_free_space is None:
+            raise ValueError('Invalid free space %r'
+                             % args['--min-free-space'])
+    if bandwidth_file:
+        bandwidth_limit, download_share = read_bandwidth_file(bandwidth_file)
 
     if debug_mode:
         # Display log messages.
@@ -91,14 +288,91 @@ def main():
     metadata = key_value_to_dict(args['--metadata'])
 
     tu = TubeUp(verbose=not quiet_mode,
-                output_template=args['--output'])
+                output_template=args['--output'],
+                pipeline_depth=pipeline_depth,
+                download_workers=download_workers,
+                upload_workers=upload_workers,
+                file_upload_workers=file_upload_workers,
+                preflight_workers=preflight_workers,
+                missing_item_ttl=missing_item_ttl,
+                bulk_prefetch=bulk_prefetch,
+                download_archive_backend=download_archive_backend,
+                incremental_sync=incremental_sync,
+                extractor_limits=extractor_limits,
+                bandwidth_limit=bandwidth_limit,
+                download_share=download_share,
+                min_free_space=min_free_space,
+                multipart_threshold=multipart_threshold,
+                multipart_workers=int(args['--multipart-workers']))
+
+    if bandwidth_file:
+        def reload_bandwidth_file():
+            try:
+                tu.bandwidth.configure(*read_bandwidth_file(bandwidth_file))
+            except (OSError, ValueError) as e:
+                print('Could not reload the bandwidth file: %s' % e,
+                      file=sys.stderr)
+
+        def on_sighup(*_):
+            # The main thread may hold the lock of the budget when the signal
+            # is handled, the budget is configured from another thread.
+            threading.Thread(target=reload_bandwidth_file,
+                             daemon=True).start()
+
+        signal.signal(signal.SIGHUP, on_sighup)
 
     try:
-        for identifier, meta in tu.archive_urls(URLs, metadata,
-                                                cookie_file, proxy_url,
-                                                username, password,
-                                                use_download_archive,
-                                                ignore_existing_item):
+        if args['enqueue']:
+            job_queue = JobQueue(args['<queue>'])
+            count = tu.enqueue_urls(job_queue, URLs, cookie_file, proxy_url,
+                                    username, password)
+            print(':: %d url(s) added to the job queue' % count)
+            return
+
+        for query in args['--prefetch-query']:
+            tu.prefetch_existing_items(query)
+
+        if args['worker']:
+            worker = args['--worker-id'] or '%s-%d' % (socket.gethostname(),
+                                                       os.getpid())
+            results = tu.run_worker(JobQueue(args['<queue>']), worker,
+                                    metadata, cookie_file, proxy_url,
+                                    username, password,
+                                    use_download_archive,
+                                    ignore_existing_item,
+                                    flat_playlist=flat_playlist,
+                                    lease_time=int(args['--lease-time']),
+                                    poll_interval=int(args['--poll-interval']),
+                                    exit_when_empty=args['--exit-when-empty'])
+        elif args['daemon']:
+            channels = parse_channels_file(args['<channels-file>'],
+                                           int(args['--channel-interval']))
+            # Finish the running poll before stopping
+            stop_event = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+            results = tu.run_daemon(channels, metadata,
+                                    cookie_file, proxy_url,
+                                    username, password,
+                                    use_download_archive,
+                                    ignore_existing_item,
+                                    flat_playlist=flat_playlist,
+                                    stop_event=stop_event)
+        elif args['--batch-file']:
+            results = tu.archive_batch_file(args['--batch-file'], metadata,
+                                            cookie_file, proxy_url,
+                                            username, password,
+                                            use_download_archive,
+                                            ignore_existing_item,
+                                            flat_playlist=flat_playlist)
+        else:
+            results = tu.archive_urls(URLs, metadata,
+                                      cookie_file, proxy_url,
+                                      username, password,
+                                      use_download_archive,
+                                      ignore_existing_item,
+                                      flat_playlist=flat_playlist)
+
+        for identifier, meta in results:
             print('\n:: Upload Finished. Item information:')
             print('Title: %s' % meta['title'])
             print('Item URL: https://archive.org/details/%s\n' % identifier)
@@ -0,0 +1,241 @@
+import io
+import os
+import math
+import time
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from logging import getLogger
+
+
+# Size of every part but the last one, S3 wants at least 5 MiB.
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+
+# S3 doesn't accept more parts for a single object.
+MAX_PARTS = 10000
+
+# Longest wait, in seconds, between two attempts of a part.
+MAX_RETRY_DELAY = 300
+
+
+def _find_all(element, tag):
+    # S3 answers with or without its XML namespace
+    return [child for child in element.iter()
+            if child.tag.rsplit('}', 1)[-1] == tag]
+
+
+def _find_text(element, tag):
+    children = _find_all(element, tag)
+    return children[0].text if children else None
+
+
+class MultipartUpload(object):
+    """
+    Upload a file to S3 in parts sent at the same time.
+
+    Every part is retried on its own, and the upload id is kept in a
+    `MultipartUploads` store so an interrupted upload only sends the parts
+    S3 doesn't have yet.
+    """
+
+    def __init__(self, session, url, filepath,
+                 part_size=DEFAULT_PART_SIZE,
+                 workers=4,
+                 retries=5,
+                 retry_delay=5,
+                 headers=None,
+                 auth=None,
+                 store=None):
+        """
+        :param session:      A `requests.Session` that will be used for the
+                             requests.
+        :param url:          Url of the object, e.g.
+                             https://s3.us.archive.org/<item>/<file>.
+        :param filepath:     Path of the file that will be uploaded.
+        :param part_size:    Number of bytes of every part, raised when the
+                             file would need more than `MAX_PARTS` parts.
+        :param workers:      Number of parts that will be uploaded at the
+                             same time.
+        :param retries:      Number of times a failing part is sent again.
+        :param retry_delay:  Number of seconds before the first retry of a
+                             part, doubled after every retry.
+        :param headers:      Headers of the request starting the upload.
+        :param auth:         Authentication of the requests, e.g. an
+                             `internetarchive.auth.S3Auth`.
+        :param store:        A `MultipartUploads` to resume the upload from,
+                             None starts a new upload every time.
+        """
+        self.session = session
+        self.url = url
+        self.filepath = filepath
+        self.size = os.path.getsize(filepath)
+        self.part_size = max(part_size, math.ceil(self.size / MAX_PARTS))
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.headers = headers or {}
+        self.auth = auth
+        self.store = store
+        self.logger = getLogger(__name__)
+        self._file_lock = threading.Lock()
+
+    @property
+    def part_count(self):
+        return max(1, math.ceil(self.size / self.part_size))
+
+    def upload(self):
+        """
+        Upload the file, sending only the parts missing from an earlier
+        attempt.
+
+        :return:  The response of the request completing the upload.
+        """
+        mtime = os.path.getmtime(self.filepath)
+        upload_id = None
+        etags = {}
+        stored = self.store.get(self.url) if self.store else None
+        if stored and tuple(stored[1:]) == (self.size, mtime):
+            upload_id = stored[0]
+            etags = self.list_parts(upload_id)
+            if etags is None:
+                upload_id = None
+                etags = {}
+            else:
+                self.logger.info('Resuming the upload of %s, %d of %d parts '
+                                 'have been uploaded'
+                                 % (self.filepath, len(etags),
+                                    self.part_count))
+
+        if upload_id is None:
+            upload_id = self.initiate()
+            if self.store:
+                self.store.set(self.url, upload_id, self.size, mtime)
+
+        missing_parts = [number for number in range(1, self.part_count + 1)
+                         if number not in etags]
+        with open(self.filepath, 'rb') as f, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            uploads = {number: executor.submit(self.upload_part, f,
+                                               upload_id, number)
+                       for number in missing_parts}
+            for number, upload in uploads.items():
+                etags[number] = upload.result()
+
+        response = self.complete(upload_id, etags)
+        if self.store:
+            self.store.delete(self.url)
+        return response
+
+    def initiate(self):
+        """
+        Start a multipart upload.
+
+        :return:  Id of the upload.
+        """
+        response = self.request('POST', self.url, params={'uploads': ''},
+                                headers=self.headers)
+        return _find_text(ElementTree.fromstring(response.content),
+                          'UploadId')
+
+    def list_parts(self, upload_id):
+        """
+        List the parts S3 already has.
+
+        :param upload_id:  Id of the upload.
+        :return:           A dict of part numbers to ETags, None if the
+                           upload doesn't exist anymore.
+        """
+        etags = {}
+        marker = None
+        while True:
+            params = {'uploadId': upload_id}
+            if marker:
+                params['part-number-marker'] = marker
+            try:
+                response = self.request('GET', self.url, params=params)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    return None
+                raise
+            root = ElementTree.fromstring(response.content)
+            for part in _find_all(root, 'Part'):
+                etags[int(_find_text(part, 'PartNumber'))] = (
+                    _find_text(part, 'ETag'))
+            if _find_text(root, 'IsTruncated') != 'true':
+                return etags
+            marker = _find_text(root, 'NextPartNumberMarker')
+
+    def upload_part(self, f, upload_id, number):
+        """
+        Upload a part, retrying it until it has been received.
+
+        :param f:          The file, opened in binary mode.
+        :param upload_id:  Id of the upload.
+        :param number:     Number of the part, from 1.
+        :return:           ETag of the part.
+        """
+        with self._file_lock:
+            f.seek((number - 1) * self.part_size)
+            data = f.read(self.part_size)
+        params = {'partNumber': number, 'uploadId': upload_id}
+        response = self.request('PUT', self.url, params=params,
+                                data=io.BytesIO(data), rewind=True)
+        return response.headers['ETag']
+
+    def complete(self, upload_id, etags):
+        """
+        Join the parts into the object.
+
+        :param upload_id:  Id of the upload.
+        :param etags:      A dict of part numbers to ETags.
+        :return:           The response of the request.
+        """
+        root = ElementTree.Element('CompleteMultipartUpload')
+        for number in sorted(etags):
+            part = ElementTree.SubElement(root, 'Part')
+            ElementTree.SubElement(part, 'PartNumber').text = str(number)
+            ElementTree.SubElement(part, 'ETag').text = etags[number]
+        response = self.request('POST', self.url,
+                                params={'uploadId': upload_id},
+                                data=ElementTree.tostring(root))
+        # The join can still fail once the response has started
+        if _find_all(ElementTree.fromstring(response.content), 'Error'):
+            raise Exception('Could not complete the upload of %s: %s'
+                            % (self.filepath, response.text))
+        return response
+
+    def request(self, method, url, rewind=False, **kwargs):
+        """
+        Send a request, retrying it on connection errors and server errors.
+
+        :param rewind:  Seek the file-like body back to its start before
+                        every retry.
+        :return:        The response, client errors raise
+                        `requests.HTTPError` at once.
+        """
+        for attempt in range(self.retries + 1):
+            if rewind:
+                kwargs['data'].seek(0)
+            try:
+                response = self.session.request(method, url, auth=self.auth,
+                                                **kwargs)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(
+                    '%d Server Error for url: %s'
+                    % (response.status_code, response.url),
+                    response=response)
+            except requests.HTTPError:
+                raise
+            except requests.RequestException as e:
+                error = e
+
+            if attempt == self.retries:
+                raise error
+            delay = min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY)
+            self.logger.warning('%s %s failed: %s, retrying in %d seconds'
+                                % (method, url, error, delay))
+            time.sleep(delay)
@@ -0,0 +1,374 @@
+import time
+import shutil
+import threading
+import contextlib
+
+from requests.adapters import HTTPAdapter
+from yt_dlp.utils import parse_bytes
+
+
+class TokenBucket(object):
+    """
+    Limit how often something happens, a token is taken every time and the
+    tokens come back at `rate` per second, up to `capacity` of them.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate:      Number of tokens added every second.
+        :param capacity:  Number of tokens that can be taken at once after
+                          the bucket has been idle.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until there is one.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens +
+                               (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Taking a missing token reserves the next one, so the threads
+            # waiting at the same time are spread over the coming tokens.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ExtractorScheduler(object):
+    """
+    Limit the extractions and downloads of every extractor, both in the
+    number of them running at the same time and in how often they may
+    start.
+    """
+
+    def __init__(self, limits=None):
+        """
+        :param limits:  A dict of extractor keys, case insensitive, to
+                        tuples of the maximum number of calls running at the
+                        same time and the maximum number of calls started
+                        per second. None means no limit.
+        """
+        self._semaphores = {}
+        self._buckets = {}
+        for extractor_key, (concurrency, rate) in (limits or {}).items():
+            if concurrency:
+                self._semaphores[extractor_key.lower()] = (
+                    threading.BoundedSemaphore(concurrency))
+            if rate:
+                self._buckets[extractor_key.lower()] = TokenBucket(rate)
+
+    @contextlib.contextmanager
+    def slot(self, extractor_key):
+        """
+        Wait until a call of an extractor may run and hold its place while
+        it runs.
+
+        :param extractor_key:  Key of the extractor, e.g. the `ie_key` of an
+                               unextracted entry or the `extractor_key` of
+                               an info dict.
+        """
+        key = (extractor_key or '').lower()
+        semaphore = self._semaphores.get(key)
+        bucket = self._buckets.get(key)
+
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            if bucket is not None:
+                bucket.acquire()
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+
+class BandwidthBudget(object):
+    """
+    A bandwidth limit shared by all the downloads and uploads of the
+    process.
+
+    The budget is either split between the stages with a fixed share, or
+    adaptively, every running transfer getting the same part of it no matter
+    its stage. The limit and the share can be changed at any time, the
+    running transfers follow the change.
+    """
+
+    STAGES = ('download', 'upload')
+
+    def __init__(self, limit=None, download_share=None):
+        """
+        :param limit:           Number of bytes per second of all the
+                                transfers, None means no limit.
+        :param download_share:  Part of the limit, between 0 and 1 excluded,
+                                given to the downloads, the uploads get the
+                                rest. None splits the limit adaptively.
+        """
+        self._lock = threading.Lock()
+        self._transfers = []
+        self.configure(limit, download_share)
+
+    def configure(self, limit=None, download_share=None):
+        """
+        Change the limit and the share of the downloads.
+
+        :param limit:           Number of bytes per second of all the
+                                transfers, None means no limit.
+        :param download_share:  Part of the limit given to the downloads,
+                                None splits the limit adaptively.
+        """
+        # A stage without any share would get a rate of 0, which would let
+        # it run without any limit.
+        if download_share is not None and not 0 < download_share < 1:
+            raise ValueError('The download share must be between 0 and 1 '
+                             'excluded')
+        with self._lock:
+            self.limit = limit
+            self.download_share = download_share
+            self._update_rates()
+
+    def _update_rates(self):
+        for transfer in self._transfers:
+            if not self.limit:
+                rate = None
+            elif self.download_share is None:
+                rate = self.limit / len(self._transfers)
+            else:
+                share = self.download_share
+                if transfer.stage == 'upload':
+                    share = 1 - share
+                rate = self.limit * share / sum(
+                    1 for t in self._transfers if t.stage == transfer.stage)
+            transfer.set_rate(rate)
+
+    @contextlib.contextmanager
+    def transfer(self, stage, on_rate=None):
+        """
+        Draw from the budget for the time of a transfer.
+
+        :param stage:    'download' or 'upload'.
+        :param on_rate:  A function called with the number of bytes per
+                         second of the transfer every time it changes, None
+                         meaning no limit.
+        :return:         A `Transfer` to pace the transfer with.
+        """
+        if stage not in self.STAGES:
+            raise ValueError('Unknown transfer stage %r' % stage)
+        transfer = Transfer(stage, on_rate)
+        with self._lock:
+            self._transfers.append(transfer)
+            self._update_rates()
+        try:
+            yield transfer
+        finally:
+            with self._lock:
+                self._transfers.remove(transfer)
+                self._update_rates()
+
+
+class Transfer(object):
+    """
+    A download or upload drawing from a `BandwidthBudget`.
+    """
+
+    def __init__(self, stage, on_rate=None):
+        self.stage = stage
+        self.rate = None
+        self._on_rate = on_rate
+        self._allowed_at = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        if self._on_rate is not None:
+            self._on_rate(rate)
+
+    def pace(self, byte_count):
+        """
+        Wait until `byte_count` more bytes may be transferred.
+        """
+        rate = self.rate
+        now = time.monotonic()
+        if not rate:
+            self._allowed_at = now
+            return
+        self._allowed_at = max(self._allowed_at, now) + byte_count / rate
+        if self._allowed_at > now:
+            time.sleep(self._allowed_at - now)
+
+
+class ThrottledReader(object):
+    """
+    A file-like object reading another one at the rate of a `Transfer`.
+    """
+
+    def __init__(self, f, transfer):
+        self._f = f
+        self._transfer = transfer
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        if data:
+            self._transfer.pace(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+class ThrottledUploadAdapter(HTTPAdapter):
+    """
+    An HTTP adapter sending the request bodies at the rate the uploads get
+    from a `BandwidthBudget`.
+
+    Only the bodies actually sent go through it, the checksums computed
+    beforehand by `internetarchive` read the files at full speed.
+    """
+
+    def __init__(self, budget, **kwargs):
+        self.budget = budget
+        super(ThrottledUploadAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if not hasattr(request.body, 'read'):
+            return super(ThrottledUploadAdapter, self).send(request, **kwargs)
+        with self.budget.transfer('upload') as transfer:
+            request.body = ThrottledReader(request.body, transfer)
+            return super(ThrottledUploadAdapter, self).send(request, **kwargs)
+
+
+class DiskSpaceGate(object):
+    """
+    Admit downloads only while the free disk space, minus the size of the
+    downloads that are running, stays above a watermark.
+
+    Downloads that don't fit wait for the running downloads to finish and
+    for the uploads expected to delete their files, or are turned down when
+    there is nothing left to wait for.
+    """
+
+    def __init__(self, min_free=None, poll_interval=30):
+        """
+        :param min_free:       Number of bytes that must stay free on the
+                               disk, None disables the gate.
+        :param poll_interval:  Number of seconds between two checks of the
+                               free space while a download waits, to notice
+                               the space freed by other processes.
+        """
+        self.min_free = min_free
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._reserved = []
+        self._expected = set()
+
+    def _fits(self, path, size):
+        reserved = sum(self._reserved)
+        return (shutil.disk_usage(path).free - reserved - size >=
+                self.min_free)
+
+    @contextlib.contextmanager
+    def reserve(self, path, size):
+        """
+        Hold the space of a download while it runs.
+
+        :param path:  A path on the disk the download is written to.
+        :param size:  Estimated number of bytes of the download.
+        :return:      True if the download has been admitted, False if it
+                      doesn't fit and nothing will free space for it.
+        """
+        if self.min_free is None:
+            yield True
+            return
+
+        with self._condition:
+            while not self._fits(path, size):
+                if not self._reserved and not self._expected:
+                    admitted = False
+                    break
+                self._condition.wait(self.poll_interval)
+            else:
+                admitted = True
+                self._reserved.append(size)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                with self._condition:
+                    self._reserved.remove(size)
+                    self._condition.notify_all()
+
+    def expect_free(self, key):
+        """
+        Tell the gate that the files of a finished download will be deleted,
+        the downloads that don't fit wait for it.
+
+        :param key:  A key of the download, e.g. its basename.
+        """
+        with self._condition:
+            self._expected.add(key)
+
+    def freed(self, key):
+        """
+        Tell the gate that the files of a download have been deleted or
+        won't be.
+
+        :param key:  The key given to `expect_free`.
+        """
+        with self._condition:
+            self._expected.discard(key)
+            self._condition.notify_all()
+
+
+def read_bandwidth_file(filepath):
+    """
+    Read the bandwidth budget from a file made of the limit, e.g. 10M,
+    optionally followed by the share of the downloads, e.g. 0.5. A limit
+    of 0 or none means no limit.
+
+    :param filepath:  Path of the file.
+    :return:          Tuple of the limit in bytes per second and the share
+                      of the downloads, None for the ones that aren't set.
+    """
+    with open(filepath, 'r', encoding='utf-8') as f:
+        fields = f.read().split()
+    if not fields or len(fields) > 2:
+        raise ValueError('%s: expected a limit and an optional download '
+                         'share' % filepath)
+
+    limit = None
+    if fields[0].lower() not in ('0', 'none'):
+        limit = parse_bytes(fields[0])
+        if limit is None:
+            raise ValueError('%s: invalid limit %r' % (filepath, fields[0]))
+    download_share = float(fields[1]) if len(fields) == 2 else None
+    return limit, download_share
+
+
+def parse_extractor_limits(specs):
+    """
+    Parse extractor limits written as <extractor>:<concurrency> or
+    <extractor>:<concurrency>:<requests per second>, an empty or 0
+    concurrency means no concurrency limit.
+
+    :param specs:  A list of limits.
+    :return:       A dict that can be given to `ExtractorScheduler`.
+    """
+    limits = {}
+    for spec in specs:
+        fields = spec.split(':')
+        try:
+            if len(fields) not in (2, 3) or not fields[0]:
+                raise ValueError
+            concurrency = int(fields[1]) if fields[1] else None
+            rate = float(fields[2]) if len(fields) == 3 else None
+        except ValueError:
+            raise ValueError('Invalid extractor limit %r, expected '
+                             '<extractor>:<concurrency>[:<rate>]' % spec) from None
+        limits[fields[0]] = (concurrency, rate)
+    return limits
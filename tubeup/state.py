@@ -0,0 +1,492 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+class SQLiteStore(object):
+    """
+    Base class of the state tubeup keeps in sqlite databases.
+
+    The connection is shared by all the threads of the process and every
+    call is serialized with a lock. Databases are opened in WAL mode so
+    several tubeup processes can use the same file at the same time.
+    """
+
+    SCHEMA = ''
+    JOURNAL_MODE = 'WAL'
+
+    def __init__(self, path):
+        """
+        :param path:  Path of the sqlite database, created if it doesn't
+                      exist yet.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60,
+                                           check_same_thread=False)
+        with self._lock:
+            self._connection.execute(
+                'PRAGMA journal_mode=%s' % self.JOURNAL_MODE)
+            self._connection.executescript(self.SCHEMA)
+
+    def execute(self, sql, parameters=()):
+        """
+        Run a statement in its own transaction.
+
+        :param sql:         The SQL statement.
+        :param parameters:  Parameters of the statement.
+        :return:            List of the rows returned by the statement.
+        """
+        with self._lock, self._connection:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ItemExistenceCache(SQLiteStore):
+    """
+    Remember which archive.org items exist across runs.
+
+    Items that exist are remembered for good, items that are missing are
+    only remembered for `missing_ttl` seconds since they may be uploaded
+    at any time.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS items (
+            identifier TEXT PRIMARY KEY,
+            item_exists INTEGER NOT NULL,
+            checked_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path, missing_ttl=86400):
+        """
+        :param path:         Path of the sqlite database.
+        :param missing_ttl:  Number of seconds an item is known to be
+                             missing after it was checked.
+        """
+        super(ItemExistenceCache, self).__init__(path)
+        self.missing_ttl = missing_ttl
+
+    def get(self, identifier):
+        """
+        Get the cached existence of an item.
+
+        :param identifier:  Identifier of the archive.org item.
+        :return:            True or False, None if the item isn't cached or
+                            its answer has expired.
+        """
+        rows = self.execute(
+            'SELECT item_exists, checked_at FROM items WHERE identifier = ?',
+            (identifier,))
+        if not rows:
+            return None
+
+        item_exists, checked_at = rows[0]
+        if item_exists:
+            return True
+        if time.time() - checked_at < self.missing_ttl:
+            return False
+        return None
+
+    def set(self, identifier, item_exists):
+        """
+        Cache the existence of an item.
+
+        :param identifier:   Identifier of the archive.org item.
+        :param item_exists:  Whether the item exists.
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO items (identifier, item_exists, checked_at) '
+            'VALUES (?, ?, ?)',
+            (identifier, bool(item_exists), time.time()))
+
+
+class DownloadArchive(SQLiteStore):
+    """
+    A yt-dlp download archive kept in sqlite, to be given to YoutubeDL as
+    its `download_archive` option.
+
+    Unlike the text archive it doesn't have to be loaded in memory when
+    YoutubeDL starts, lookups use the primary key index and several
+    processes can record downloads at the same time.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS archive (
+            archive_id TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS imported_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL
+        );
+    '''
+
+    def __contains__(self, archive_id):
+        return bool(self.execute(
+            'SELECT 1 FROM archive WHERE archive_id = ?', (archive_id,)))
+
+    def __bool__(self):
+        # YoutubeDL skips the lookups when the archive is falsy, counting
+        # the rows of a large archive would cost more than a lookup.
+        return True
+
+    def add(self, archive_id):
+        self.execute('INSERT OR IGNORE INTO archive (archive_id) VALUES (?)',
+                     (archive_id,))
+
+    def import_file(self, path):
+        """
+        Import the entries of a yt-dlp text download archive. A file is only
+        imported again after it has been modified.
+
+        :param path:  Path of the text download archive.
+        :return:      Number of entries that were added to the archive, 0
+                      if the file doesn't exist or hasn't changed since its
+                      last import.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 0
+
+        path = os.path.realpath(path)
+        if self.execute(
+                'SELECT 1 FROM imported_files '
+                'WHERE path = ? AND size = ? AND mtime = ?',
+                (path, stat.st_size, stat.st_mtime)):
+            return 0
+
+        with open(path, 'r', encoding='utf-8') as f, \
+                self._lock, self._connection:
+            archive_ids = ((line.strip(),) for line in f if line.strip())
+            count = self._connection.executemany(
+                'INSERT OR IGNORE INTO archive (archive_id) VALUES (?)',
+                archive_ids).rowcount
+            self._connection.execute(
+                'INSERT OR REPLACE INTO imported_files (path, size, mtime) '
+                'VALUES (?, ?, ?)', (path, stat.st_size, stat.st_mtime))
+        return count
+
+
+class JobStore(SQLiteStore):
+    """
+    Remember the state of every video tubeup has worked on so an
+    interrupted run can be resumed.
+
+    A job goes from 'discovered' to 'downloaded' once its files are in the
+    downloads directory, to 'uploaded' once they have been uploaded and to
+    'verified' once its item has been seen on archive.org. A job that
+    couldn't be uploaded is 'failed' with the reason of the failure.
+    """
+
+    STATES = ('discovered', 'downloaded', 'uploaded', 'verified', 'failed')
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            identifier TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            basename TEXT,
+            reason TEXT,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+        CREATE INDEX IF NOT EXISTS jobs_basename ON jobs (basename);
+    '''
+
+    def get(self, identifier):
+        """
+        Get the state of a job.
+
+        :param identifier:  Identifier of the archive.org item of the job.
+        :return:            Tuple of the state and the basename of the job,
+                            None if the job is unknown.
+        """
+        rows = self.execute(
+            'SELECT state, basename FROM jobs WHERE identifier = ?',
+            (identifier,))
+        return rows[0] if rows else None
+
+    def set_state(self, identifier, state, basename=None, reason=None):
+        """
+        Move a job to a new state, the job is created if it's unknown.
+
+        :param identifier:  Identifier of the archive.org item of the job.
+        :param state:       One of `STATES`.
+        :param basename:    Basename of the downloaded files of the job, the
+                            previous basename is kept when it's None.
+        :param reason:      Why the job has failed.
+        """
+        if state not in self.STATES:
+            raise ValueError('Unknown job state %r' % state)
+        self.execute(
+            'INSERT INTO jobs (identifier, state, basename, reason, updated_at) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (identifier) DO UPDATE SET state = excluded.state, '
+            'basename = COALESCE(excluded.basename, jobs.basename), '
+            'reason = excluded.reason, updated_at = excluded.updated_at',
+            (identifier, state, basename, reason, time.time()))
+
+    def fail_basename(self, basename, reason):
+        """
+        Mark the jobs of a basename as failed.
+
+        :param basename:  Basename of the downloaded files of the job.
+        :param reason:    Why the job has failed.
+        """
+        self.execute(
+            "UPDATE jobs SET state = 'failed', reason = ?, updated_at = ? "
+            "WHERE basename = ?", (reason, time.time(), basename))
+
+    def jobs_in_state(self, state):
+        """
+        List the jobs in a state.
+
+        :param state:  One of `STATES`.
+        :return:       List of tuples of the identifier and the basename of
+                       the jobs.
+        """
+        return self.execute(
+            'SELECT identifier, basename FROM jobs WHERE state = ? '
+            'ORDER BY updated_at', (state,))
+
+
+class JobQueue(SQLiteStore):
+    """
+    A queue of urls shared by the tubeup workers of several machines.
+
+    A worker leases a url while it archives it and renews the lease with
+    heartbeats. The url of a worker that stops sending heartbeats is
+    handed to another worker once its lease has expired.
+    """
+
+    # WAL needs shared memory between the processes, which network file
+    # systems don't provide, the queue is meant to be shared that way.
+    JOURNAL_MODE = 'DELETE'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS queue (
+            job_id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            state TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS queue_state ON queue (state, lease_expires);
+    '''
+
+    def enqueue(self, urls):
+        """
+        Add urls to the queue, urls that have already been queued are
+        ignored.
+
+        :param urls:  An iterable of urls.
+        :return:      Number of urls that have been added.
+        """
+        with self._lock, self._connection:
+            return self._connection.executemany(
+                'INSERT OR IGNORE INTO queue (url) VALUES (?)',
+                ((url,) for url in urls)).rowcount
+
+    def claim(self, worker, lease_time):
+        """
+        Lease the oldest pending url, or a url whose lease has expired.
+
+        :param worker:      Name of the worker taking the url.
+        :param lease_time:  Number of seconds the url is leased for.
+        :return:            Tuple of the job id and the url, None if there
+                            is nothing to do.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            # Take the write lock right away so two workers can't select
+            # the same url.
+            self._connection.execute('BEGIN IMMEDIATE')
+            row = self._connection.execute(
+                "SELECT job_id, url FROM queue WHERE state = 'pending' OR "
+                "(state = 'leased' AND lease_expires < ?) "
+                "ORDER BY job_id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE queue SET state = 'leased', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE job_id = ?",
+                (worker, now + lease_time, row[0]))
+        return row
+
+    def heartbeat(self, job_id, worker, lease_time):
+        """
+        Renew the lease of a url.
+
+        :param job_id:      Id of the job returned by `claim`.
+        :param worker:      Name of the worker holding the lease.
+        :param lease_time:  Number of seconds the lease is renewed for.
+        :return:            False if the worker has lost the lease.
+        """
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "UPDATE queue SET lease_expires = ? WHERE job_id = ? AND "
+                "worker = ? AND state = 'leased'",
+                (time.time() + lease_time, job_id, worker)).rowcount == 1
+
+    def complete(self, job_id, worker):
+        """
+        Mark a leased url as archived.
+
+        :param job_id:  Id of the job returned by `claim`.
+        :param worker:  Name of the worker holding the lease.
+        """
+        self.execute(
+            "UPDATE queue SET state = 'done', lease_expires = NULL, "
+            "error = NULL WHERE job_id = ? AND worker = ?", (job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        """
+        Mark a leased url as failed, it isn't handed out again.
+
+        :param job_id:  Id of the job returned by `claim`.
+        :param worker:  Name of the worker holding the lease.
+        :param error:   Why archiving the url has failed.
+        """
+        self.execute(
+            "UPDATE queue SET state = 'failed', lease_expires = NULL, "
+            "error = ? WHERE job_id = ? AND worker = ?",
+            (error, job_id, worker))
+
+    def counts(self):
+        """
+        :return:  A dict of the number of urls in every state.
+        """
+        return dict(self.execute(
+            'SELECT state, COUNT(*) FROM queue GROUP BY state'))
+
+
+class SyncMarks(SQLiteStore):
+    """
+    Remember, for every playlist synced incrementally, the newest entry
+    from which on all the older entries are archived.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS marks (
+            playlist TEXT PRIMARY KEY,
+            entry_id TEXT NOT NULL,
+            entry_date TEXT,
+            updated_at REAL NOT NULL
+        );
+    '''
+
+    def get(self, playlist):
+        """
+        Get the mark of a playlist.
+
+        :param playlist:  Key of the playlist, its extractor key and its id.
+        :return:          Tuple of the id and the upload date (YYYYMMDD or
+                          None) of the marked entry, None if the playlist
+                          has no mark yet.
+        """
+        rows = self.execute(
+            'SELECT entry_id, entry_date FROM marks WHERE playlist = ?',
+            (playlist,))
+        return rows[0] if rows else None
+
+    def set(self, playlist, entry_id, entry_date=None):
+        """
+        Move the mark of a playlist.
+
+        :param playlist:    Key of the playlist, its extractor key and its id.
+        :param entry_id:    Id of the marked entry.
+        :param entry_date:  Upload date of the marked entry, as YYYYMMDD.
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO marks '
+            '(playlist, entry_id, entry_date, updated_at) VALUES (?, ?, ?, ?)',
+            (playlist, entry_id, entry_date, time.time()))
+
+
+class BatchCheckpoints(SQLiteStore):
+    """
+    Remember how far the urls of every batch file have been archived.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            path TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    '''
+
+    def get(self, path):
+        """
+        :param path:  Real path of the batch file.
+        :return:      Offset in bytes of the first line that hasn't been
+                      archived, 0 if the file has no checkpoint.
+        """
+        rows = self.execute(
+            'SELECT offset FROM checkpoints WHERE path = ?', (path,))
+        return rows[0][0] if rows else 0
+
+    def set(self, path, offset):
+        """
+        :param path:    Real path of the batch file.
+        :param offset:  Offset in bytes of the first line that hasn't been
+                        archived.
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO checkpoints (path, offset, updated_at) '
+            'VALUES (?, ?, ?)', (path, offset, time.time()))
+
+
+class MultipartUploads(SQLiteStore):
+    """
+    Remember the multipart uploads that have been started, so an
+    interrupted upload only sends the parts that are missing.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS uploads (
+            url TEXT PRIMARY KEY,
+            upload_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    '''
+
+    def get(self, url):
+        """
+        :param url:  Url of the uploaded object.
+        :return:     Tuple of the upload id and of the size and the
+                     modification time the file had when the upload was
+                     started, None if there is no upload of the url.
+        """
+        rows = self.execute(
+            'SELECT upload_id, size, mtime FROM uploads WHERE url = ?',
+            (url,))
+        return rows[0] if rows else None
+
+    def set(self, url, upload_id, size, mtime):
+        """
+        :param url:        Url of the uploaded object.
+        :param upload_id:  Id of the multipart upload.
+        :param size:       Size of the uploaded file.
+        :param mtime:      Modification time of the uploaded file.
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO uploads '
+            '(url, upload_id, size, mtime, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (url, upload_id, size, mtime, time.time()))
+
+    def delete(self, url):
+        """
+        Forget the upload of an url once it has been completed.
+        """
+        self.execute('DELETE FROM uploads WHERE url = ?', (url,))
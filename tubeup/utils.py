@@ -1,11 +1,26 @@
 import os
 import re
-from collections import defaultdict
+import internetarchive
+from collections import OrderedDict, defaultdict, namedtuple
+from internetarchive.auth import S3Auth
+from yt_dlp.extractor import gen_extractor_classes
 
 
 EMPTY_ANNOTATION_FILE = ('<?xml version="1.0" encoding="UTF-8" ?>'
                          '<document><annotations></annotations></document>')
 
+# Extensions of the files yt-dlp writes next to the media, the subtitles and
+# thumbnails ones being preceded by the language or nothing.
+SIDECAR_EXTENSIONS = frozenset([
+    'info.json', 'description', 'annotations.xml', 'live_chat.json',
+    'jpg', 'jpeg', 'png', 'webp',
+    'vtt', 'srt', 'ass', 'lrc', 'ttml', 'srv1', 'srv2', 'srv3', 'json3'])
+
+# Extensions of the files yt-dlp is still writing.
+IN_PROGRESS_EXTENSIONS = ('.part', '.ytdl', '.temp')
+
+JobFiles = namedtuple('JobFiles', ['media', 'sidecars', 'stubs'])
+
 
 def key_value_to_dict(lst):
     """
@@ -39,13 +54,236 @@ def get_itemname(infodict):
     ))
 
 
+def match_url_extractor(url):
+    """
+    Find the yt-dlp extractor of an url and the id it would extract, only
+    from the url patterns, without any request.
+
+    :param url:  An url supported by yt-dlp.
+    :return:     Tuple of the extractor class and the id, the id is None
+                 when the extractor can't tell it from the url alone.
+    """
+    for ie in gen_extractor_classes():
+        if ie.suitable(url):
+            return ie, ie.get_temp_id(url)
+    return None, None
+
+
+def is_video_entry(ydl, entry):
+    """
+    Tell whether an entry of a playlist extracted without processing is a
+    video, and not a playlist or a tab, without extracting it.
+
+    :param ydl:    A `YoutubeDL` to look up the extractor of url entries.
+    :param entry:  An entry of a playlist.
+    :return:       True when the entry is a video.
+    """
+    entry_type = entry.get('_type', 'video')
+    if entry_type in ('url', 'url_transparent') and entry.get('ie_key'):
+        ie = ydl.get_info_extractor(entry['ie_key'])
+        return getattr(ie, '_RETURN_TYPE', None) == 'video'
+    return entry_type == 'video'
+
+
+def estimate_download_size(info_dict):
+    """
+    Estimate the number of bytes a video will take once downloaded, from
+    the sizes yt-dlp knows of its selected formats.
+
+    :param info_dict:  Info dict of a video, after format selection.
+    :return:           Number of bytes, 0 when the size isn't known.
+    """
+    formats = info_dict.get('requested_formats') or [info_dict]
+    return sum(f.get('filesize') or f.get('filesize_approx') or 0
+               for f in formats)
+
+
+def check_identifier_exists(identifier, session=None):
+    """
+    Check whether an archive.org item exists without fetching its metadata.
+
+    Only the identifier field of the item is requested, so the response is a
+    few bytes no matter how many files the item has.
+
+    :param identifier:  Identifier of the archive.org item.
+    :param session:     An `internetarchive.ArchiveSession` that will be used
+                        for the request, a default one is created if not
+                        given.
+    :return:            True if the item exists, False if it's missing or
+                        archive.org answered with an error.
+    """
+    if session is None:
+        session = internetarchive.get_session()
+
+    url = '%s//%s/metadata/%s/metadata/identifier' % (
+        session.protocol, session.host, identifier)
+    s3_auth = None
+    if session.access_key and session.secret_key:
+        s3_auth = S3Auth(session.access_key, session.secret_key)
+
+    response = session.get(url, auth=s3_auth, timeout=12)
+    response.raise_for_status()
+    # The response is empty for missing items and has an error instead of
+    # the result when the metadata can't be read.
+    return 'result' in response.json()
+
+
+def iter_search_identifiers(query, session=None):
+    """
+    Iterate over the identifiers of the archive.org items matching a search
+    query.
+
+    The results are streamed from the scrape API one page at a time, every
+    page being requested with the cursor returned by the previous one.
+
+    :param query:    An archive.org search query.
+    :param session:  An `internetarchive.ArchiveSession` that will be used
+                     for the requests, a default one is created if not
+                     given.
+    :return:         A generator of item identifiers.
+    """
+    if session is None:
+        session = internetarchive.get_session()
+
+    for result in session.search_items(query, fields=['identifier']):
+        # Errors come as a result without identifier, the search raises
+        # for them right after.
+        if 'identifier' in result:
+            yield result['identifier']
+
+
+def iter_batch_file(f, offset=0):
+    """
+    Iterate over the urls of a batch file without reading it all, lines
+    that are blank or start with #, ; or ] are skipped like yt-dlp does.
+
+    :param f:       A batch file opened in binary mode.
+    :param offset:  Offset of the file position, in bytes.
+    :return:        A generator of tuples of an url and the offset of the
+                    line after it.
+    """
+    for line in f:
+        offset += len(line)
+        url = line.decode('utf-8').strip()
+        if url and not url.startswith(('#', ';', ']')):
+            yield url, offset
+
+
+def parse_channels_file(filepath, default_interval):
+    """
+    Parse a file listing the channels polled by the daemon, one channel per
+    line as an url optionally followed by its polling interval in seconds.
+    Blank lines and lines starting with # are ignored.
+
+    :param filepath:          Path of the channels file.
+    :param default_interval:  Interval of the channels without one.
+    :return:                  List of tuples of the url and the interval of
+                              every channel.
+    """
+    channels = []
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) > 2 or (len(fields) == 2 and
+                                   not fields[1].isdigit()):
+                raise ValueError('%s:%d: expected an url and an interval in '
+                                 'seconds, got %r'
+                                 % (filepath, line_number, line.strip()))
+            interval = int(fields[1]) if len(fields) == 2 else default_interval
+            channels.append((fields[0], interval))
+    return channels
+
+
+def scan_job_files(videobasename, info_dict=None):
+    """
+    Sort the files of a downloaded video, the ones named after its basename
+    followed by an extension, with a single scan of their directory.
+
+    Files yt-dlp hasn't finished are in-progress stubs: .part, .ytdl and
+    .temp files, fragments, and the formats of `info_dict` that are
+    downloaded separately and still wait to be merged. Metadata, thumbnails
+    and subtitles are sidecars, everything else is media.
+
+    :param videobasename:  A video base name.
+    :param info_dict:      Info dict of the video, its selected formats tell
+                           the unmerged ones.
+    :return:               A `JobFiles` of lists of `os.DirEntry`, which
+                           keep the `stat` results of the scan.
+    """
+    format_ids = (info_dict or {}).get('format_id', '').split('+')
+    unmerged_prefixes = tuple('f%s.' % format_id for format_id in format_ids
+                              if len(format_ids) > 1)
+
+    dirname, prefix = os.path.split(videobasename)
+    prefix += '.'
+    job_files = JobFiles([], [], [])
+    with os.scandir(dirname or '.') as entries:
+        for entry in entries:
+            if not entry.name.startswith(prefix) or not entry.is_file():
+                continue
+            extension = entry.name[len(prefix) - 1:]
+            if (extension.endswith(IN_PROGRESS_EXTENSIONS) or
+                    '.part-Frag' in extension or '.temp.' in extension or
+                    extension[1:].startswith(unmerged_prefixes)):
+                job_files.stubs.append(entry)
+            elif (extension[1:] in SIDECAR_EXTENSIONS or
+                  extension.rsplit('.', 1)[-1] in SIDECAR_EXTENSIONS):
+                job_files.sidecars.append(entry)
+            else:
+                job_files.media.append(entry)
+    return job_files
+
+
+class JobManifest(object):
+    """
+    The files yt-dlp has written for a video, as reported by its hooks.
+    """
+
+    def __init__(self):
+        self.paths = set()
+        # Set once the files have been post-processed, the last step of
+        # the download.
+        self.complete = False
+
+
+class RecentKeys(object):
+    """
+    A set that only remembers the `max_size` keys added or found last, so
+    its memory use is bounded.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key not in self._keys:
+            return False
+        self._keys.move_to_end(key)
+        return True
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+
 def check_is_file_empty(filepath):
     """
     Check whether file is empty or not.
 
-    :param filepath:  Path of a file that will be checked.
+    :param filepath:  Path of a file that will be checked, or an
+                      `os.DirEntry` whose `stat` result is reused.
     :return:          True if the file empty.
     """
+    if isinstance(filepath, os.DirEntry):
+        return filepath.stat().st_size == 0
     if os.path.exists(filepath):
         return os.stat(filepath).st_size == 0
     else: